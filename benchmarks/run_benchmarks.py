@@ -0,0 +1,29 @@
+# Benchmarks the reconstruction hot paths (harditools.benchmark.STAGES) on
+# deterministic synthetic multi-fibre phantoms, so regressions can be
+# measured without the mouse data. Every run is appended to history.jsonl
+# (kept out of git, it is per host) and compared with the best earlier run
+# of each stage on this host, e.g.
+#
+#   python run_benchmarks.py --sizes 16 24 32 --stages sh2odf calc_peaks
+import os
+import argparse
+import harditools as hd
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', type=int, nargs='+', default=[12, 16, 24],
+                    help='phantom sizes, in voxels per side')
+parser.add_argument('--schemes', nargs='+', default=['bvals_with_b0s'],
+                    choices=list(hd.benchmark.SCHEMES))
+parser.add_argument('--stages', nargs='+', default=None,
+                    choices=list(hd.benchmark.STAGES))
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--n-jobs', type=int, default=1)
+parser.add_argument('--history', default=os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'history.jsonl'))
+args = parser.parse_args()
+
+history = hd.benchmark.load_history(args.history)
+records = hd.benchmark.run_benchmarks(args.sizes, args.schemes, args.stages,
+                                      args.repeat, args.n_jobs,
+                                      history=args.history)
+print(hd.benchmark.report(records, history))
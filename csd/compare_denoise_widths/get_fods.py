@@ -1,4 +1,6 @@
+import logging
 import numpy as np
+import nibabel as nib
 import harditools as hd
 
 names = ['raw', 'denoised_k5', 'denoised_k7', 'denoised_k9']
@@ -9,17 +11,16 @@ maskfn = 'data/mask.nii.gz'
 gtab = hd.load_gtab()
 mask = hd.load_mask(maskfn)
 
-for i, datafn in enumerate(datafns):
-
-    print(names[i])
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+summary = hd.instrument.Summary()
+hd.instrument.enable(hd.instrument.LogSink(), summary)
 
-    print('Loading data')
-    img, data = hd.load_data(datafn)
-    response = hd.load_obj('responses/{}_response.pkl'.format(names[i]))
-
-    print('Fitting CSD')
-    model, fod = hd.reconst.csd(response, data, gtab, mask)
+for i, datafn in enumerate(datafns):
+    with hd.instrument.stage(names[i]):
+        img = nib.load(datafn)
+        response = hd.load_obj('responses/{}_response.pkl'.format(names[i]))
+        model, _ = hd.reconst.csd_streaming(
+            img, gtab, mask, response, 'fods/{}_fod.nii.gz'.format(names[i]))
+        hd.save_obj(model, 'models/{}_model.pkl'.format(names[i]))
 
-    print('Saving')
-    hd.save_obj(model, 'models/{}_model.pkl'.format(names[i]))
-    hd.niisave('fods/{}_fod.nii.gz'.format(names[i]), fod, img)
+print(summary.table())
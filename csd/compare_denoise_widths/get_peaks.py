@@ -1,3 +1,4 @@
+import logging
 import numpy as np
 import harditools as hd
 
@@ -9,19 +10,15 @@ maskfn = 'data/mask.nii.gz'
 gtab = hd.load_gtab()
 mask = hd.load_mask(maskfn)
 
-for i, datafn in enumerate(datafns):
-
-    print(names[i])
-
-    print('Loading data')
-    img, data = hd.load_data(datafn)
-    _, fod = hd.load_data('./fods/{}_fod.nii.gz'.format(names[i]))
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+summary = hd.instrument.Summary()
+hd.instrument.enable(hd.instrument.LogSink(), summary)
 
-    print('Calculating ODF')
-    odf = hd.reconst.sh2odf(fod[mask])
-
-    print('Calculating peaks')
-    peaks = hd.reconst.calc_peaks(odf)
+for i, datafn in enumerate(datafns):
+    with hd.instrument.stage(names[i]):
+        _, fod = hd.load_data('./fods/{}_fod.nii.gz'.format(names[i]))
+        peaks = hd.reconst.sh_to_peaks(fod[mask])
+        with hd.instrument.stage('save_peaks'):
+            peaks.save('peaks/{}_peaks'.format(names[i]), mask)
 
-    print('Saving')
-    hd.save_obj(peaks, 'peaks/{}_peaks.pkl'.format(names[i]))
+print(summary.table())
@@ -1,3 +1,4 @@
+import logging
 import numpy as np
 import harditools as hd
 
@@ -9,18 +10,15 @@ maskfn = 'data/mask.nii.gz'
 gtab = hd.load_gtab()
 mask = hd.load_mask(maskfn)
 
-for i, datafn in enumerate(datafns):
-
-    print(names[i])
-
-    print('Loading data')
-    _, data = hd.load_data(datafn)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+summary = hd.instrument.Summary()
+hd.instrument.enable(hd.instrument.LogSink(), summary)
 
-    print('Making wm_mask')
-    wm_mask = hd.reconst.wm_mask_from_data(data, gtab, mask)
-
-    print('Getting response')
-    response = hd.reconst.csd_response(data, gtab, wm_mask, sh_order=8)
+for i, datafn in enumerate(datafns):
+    with hd.instrument.stage(names[i]):
+        _, data = hd.load_data(datafn)
+        wm_mask = hd.reconst.wm_mask_from_data(data, gtab, mask, n_jobs=None)
+        response = hd.reconst.csd_response(data, gtab, wm_mask, sh_order=8)
+        hd.save_obj(response, 'responses/{}_response.pkl'.format(names[i]))
 
-    print('Saving')
-    hd.save_obj(response, 'responses/{}_response.pkl'.format(names[i]))
+print(summary.table())
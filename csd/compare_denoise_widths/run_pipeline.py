@@ -0,0 +1,83 @@
+# Runs get_response.py, get_fods.py, get_peaks.py and calc_peak_metrics.py as
+# one pipeline. Each dataset goes through its stages in its own process,
+# passing arrays along in memory, and stages whose inputs have not changed
+# since the last run are skipped.
+import runpy
+import numpy as np
+import harditools as hd
+
+names = ['raw', 'denoised_k5', 'denoised_k7', 'denoised_k9']
+datafns = dict(zip(names, ['data/raw.nii.gz'] +
+                   ['data/denoised_k{}.nii.gz'.format(k) for k in [5, 7, 9]]))
+maskfn = 'data/mask.nii.gz'
+
+
+def fit_fods(data, response, fn):
+    # Fits the array the 'data' stage already loaded rather than reading
+    # the compressed file again
+    img, data = data
+    _, fod = hd.reconst.csd(response, data, hd.load_gtab(),
+                            hd.load_mask(maskfn), dtype='float32')
+    hd.save_data(fn, fod, img)
+    return fod
+
+
+def fit_peaks(fod, path):
+    mask = hd.load_mask(maskfn)
+    peaks = hd.reconst.sh_to_peaks(fod[mask])
+    peaks.save(path, mask)
+    return peaks
+
+
+def save_wm_mask(data, fn):
+    _, data = data
+    wm_mask = hd.reconst.wm_mask_from_data(data, hd.load_gtab(),
+                                           hd.load_mask(maskfn))
+    np.save(fn, wm_mask)
+    return wm_mask
+
+
+def save_response(data, wm_mask, fn):
+    _, data = data
+    response = hd.reconst.csd_response(data, hd.load_gtab(), wm_mask,
+                                       sh_order=8)
+    hd.save_obj(response, fn)
+    return response
+
+
+def build(name):
+    pipeline = hd.pipeline.Pipeline(name)
+    wm_maskfn = 'wm_masks/{}_wm_mask.npy'.format(name)
+    responsefn = 'responses/{}_response.pkl'.format(name)
+    fodfn = 'fods/{}_fod.nii.gz'.format(name)
+    peaksfn = 'peaks/{}_peaks'.format(name)
+
+    pipeline.add('data', hd.load_data, files=[datafns[name]],
+                 params={'fn': datafns[name]})
+    pipeline.add('wm_mask', save_wm_mask, deps=['data'], files=[maskfn],
+                 outputs=[wm_maskfn], params={'fn': wm_maskfn},
+                 load=np.load)
+    pipeline.add('response', save_response, deps=['data', 'wm_mask'],
+                 outputs=[responsefn], params={'fn': responsefn},
+                 load=hd.load_obj)
+    pipeline.add('fod', fit_fods, deps=['data', 'response'], files=[maskfn],
+                 outputs=[fodfn], params={'fn': fodfn},
+                 load=lambda fn: hd.load_data(fn)[1])
+    pipeline.add('peaks', fit_peaks, deps=['fod'], files=[maskfn],
+                 outputs=[peaksfn + '/gfa.npy'], params={'path': peaksfn})
+    return pipeline
+
+
+if __name__ == '__main__':
+    print(hd.pipeline.run_datasets(build, names))
+
+    # Metrics compare all datasets, so they run once every peaks stage is
+    # up to date
+    metrics = hd.pipeline.Pipeline('metrics')
+    metrics.add('metrics', lambda: runpy.run_path('calc_peak_metrics.py'),
+                files=[maskfn] + ['peaks/{}_peaks/{}.npy'.format(name, field)
+                                  for name in names
+                                  for field in ['gfa', 'peak_values',
+                                                'peak_dirs']] +
+                ['fods/{}_fod.nii.gz'.format(name) for name in names])
+    metrics.run()
@@ -1,21 +1,28 @@
 import numpy as np
-import nibabel as nib
+import harditools as hd
 import tifffile as tf
 
+# Same inputs as fsl_dtifit.sh
+mask = hd.load_mask('../preprocess/mask/denoised_k7_mask.nii.gz')
+gtab = hd.load_gtab(bvalfn='../preprocess/registered_full/bvals_raw',
+                    bvecfn='../preprocess/registered_full/bvecs_raw')
 
-def save_color_rgb(path):
-    FA_img = nib.load(path + 'FA.nii.gz')
-    FA = FA_img.get_data()
-    PDD = nib.load(path + 'V1.nii.gz').get_data()
 
-    RGB = np.abs(PDD) * np.clip(FA, 0, 1)[..., None]
+def save_color_rgb(datafn, path):
+    # RGB comes out of the same pass as FA and the PDD
+    _, data = hd.load_data(datafn, cache=False)
+    maps = hd.reconst.dti_maps(data, gtab, mask, n_jobs=None)
+
     tf.imsave(path + 'color_fa.tif',
-              np.moveaxis(np.array(255 * RGB, 'uint8'), [0, 1, 2], [2, 0, 1]))
+              np.moveaxis(np.array(255 * maps.rgb, 'uint8'), [0, 1, 2], [2, 0, 1]))
 
 
+datafns = ['../preprocess/registered_full/raw_registered.nii.gz'] + \
+    ['../preprocess/registered_full/denoised_k{}_registered.nii.gz'.format(k)
+     for k in [5, 7, 9]]
 paths = ['raw/raw_'] + \
     ['denoised_k{0}/denoised_k{0}_'.format(k) for k in [5, 7, 9]]
 
-for path in paths:
+for datafn, path in zip(datafns, paths):
     print(path)
-    save_color_rgb(path)
+    save_color_rgb(datafn, path)
@@ -1,5 +1,5 @@
 import numpy as np
-import nibabel as nib
+import harditools as hd
 import matplotlib.pyplot as plt
 import tifffile as tf
 
@@ -10,8 +10,8 @@ plotpdd = True
 
 class tensorfit(object):
     def __init__(self, path):
-        self.fa = nib.load(path + 'FA.nii.gz').get_data()
-        self.pdd = nib.load(path + 'V1.nii.gz').get_data()
+        _, self.fa = hd.load_data(path + 'FA.nii.gz')
+        _, self.pdd = hd.load_data(path + 'V1.nii.gz')
 
 
 def ang_distance(dir1, dir2):
@@ -28,8 +28,7 @@ def ang_distance(dir1, dir2):
 if load:
     paths = ['raw/raw_'] + \
         ['denoised_k{0}/denoised_k{0}_'.format(k) for k in [5, 7, 9]]
-    mask = nib.load(
-        '../../preprocess/mask/denoised_k7_mask.nii.gz').get_data().astype('bool')
+    mask = hd.load_mask('../../preprocess/mask/denoised_k7_mask.nii.gz')
     raw, d5, d7, d9 = [tensorfit(path) for path in paths]
 
 fns = ['d5', 'd7', 'd9']
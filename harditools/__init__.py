@@ -1,3 +1,15 @@
 from harditools.utils import *
 from harditools import reconst
 from harditools import vis
+from harditools import stats
+from harditools import compare
+from harditools import registration_metrics
+from harditools import sweep
+from harditools import cache
+from harditools import pipeline
+from harditools import denoise
+from harditools import angles
+from harditools import sphere
+from harditools import phantom
+from harditools import benchmark
+from harditools import instrument
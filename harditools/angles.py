@@ -0,0 +1,86 @@
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def angle_matrix(dirs1, dirs2, antipodal=True):
+    # (N, P, Q) angles in degrees between the (N, P, 3) and (N, Q, 3) sets
+    # of directions of each voxel. With `antipodal`, d and -d are the same
+    # direction, so angles are in [0, 90]. Zero vectors (missing peaks)
+    # give nan.
+    dirs1 = np.asarray(dirs1, dtype='float64')
+    dirs2 = np.asarray(dirs2, dtype='float64')
+    norm1 = np.linalg.norm(dirs1, axis=-1)
+    norm2 = np.linalg.norm(dirs2, axis=-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos = np.matmul(dirs1, np.swapaxes(dirs2, -1, -2)) / \
+            (norm1[..., :, None] * norm2[..., None, :])
+    if antipodal:
+        cos = np.abs(cos)
+    return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+
+# Bound on the (voxels, assignments, peaks) cost temporary of match_peaks
+MATCH_BLOCK_BYTES = 32 * 1024**2
+
+
+def match_peaks(dirs1, dirs2, antipodal=True, missing_cost=90.):
+    # Optimal one-to-one matching of the peaks of each voxel: the
+    # assignment with the smallest total angle, found by trying every
+    # assignment at once (fine for the handful of peaks per voxel) on
+    # blocks of voxels small enough to keep the costs of all assignments
+    # within MATCH_BLOCK_BYTES (5 peaks: 120 assignments per voxel). Pairs
+    # with a missing peak cost `missing_cost`, so real peaks are matched
+    # with each other first. Returns (match, angles), both (N, min(P, Q)):
+    # peak i of the smaller set is matched to peak match[:, i] of the other
+    # one (dirs2 when P == Q), at angle angles[:, i] (nan when either peak
+    # is missing).
+    angles = angle_matrix(dirs1, dirs2, antipodal)
+    swapped = angles.shape[1] > angles.shape[2]
+    if swapped:
+        angles = np.swapaxes(angles, 1, 2)
+    n, p, q = angles.shape
+
+    cost = np.where(np.isnan(angles), missing_cost, angles)
+    perms = np.array(list(itertools.permutations(range(q), p)),
+                     dtype='intp').reshape(-1, p)
+    rows = np.arange(p)
+    match = np.empty((n, p), dtype='intp')
+    block = max(MATCH_BLOCK_BYTES // (perms.size * cost.itemsize), 1)
+    for start in range(0, n, block):
+        totals = cost[start:start + block, rows, perms].sum(axis=-1)
+        match[start:start + block] = perms[np.argmin(totals, axis=-1)]
+
+    matched = angles[np.arange(n)[:, None], rows, match]
+    return match, matched
+
+
+def matched_angles(dirs1, dirs2, antipodal=True):
+    # Angles of all optimally matched pairs of real peaks, flattened
+    _, angles = match_peaks(dirs1, dirs2, antipodal)
+    return angles[~np.isnan(angles)]
+
+
+def nearest_neighbor_spacing(vertices, antipodal=True, tol=1e-3, tree=None):
+    # Angle in degrees from each vertex to its nearest other vertex, from a
+    # KD-tree query. With `antipodal`, -v counts as v, and vertices closer
+    # than `tol` degrees (such as the vertex's own antipode on a symmetric
+    # sphere) are skipped. `tree` may be a prebuilt cKDTree of the unit
+    # vertices (followed by their antipodes with `antipodal`).
+    vertices = np.asarray(vertices, dtype='float64')
+    vertices = vertices / np.linalg.norm(vertices, axis=1)[:, None]
+    if tree is None:
+        tree = cKDTree(np.vstack((vertices, -vertices)) if antipodal
+                       else vertices)
+
+    min_chord = 2 * np.sin(np.radians(tol) / 2)
+    k = 2
+    while True:
+        k = min(2 * k, tree.n)
+        chord, _ = tree.query(vertices, k=k)
+        chord = np.where(chord > min_chord, chord, np.inf)
+        nearest = chord.min(axis=1)
+        if np.isfinite(nearest).all() or k == tree.n:
+            break
+    return np.degrees(2 * np.arcsin(np.clip(nearest / 2, 0, 1)))
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import socket
+import platform
+import traceback
+import subprocess
+import multiprocessing as mp
+from collections import OrderedDict
+import numpy as np
+from . import reconst
+from .utils import load_gtab
+from .instrument import proc_status, peak_rss, reset_peak_rss
+from .phantom import make_gtab, multi_fiber_phantom, WM_EVALS
+
+# Gradient schemes the phantoms can be simulated with. 'bvals_with_b0s' is
+# the 160 volume scheme of the acquired data (harditools/data).
+SCHEMES = OrderedDict([
+    ('bvals_with_b0s', lambda: load_gtab()),
+    ('b3000_64', lambda: make_gtab(ndirs=64, nb0s=4, bval=3000)),
+    ('b1000_32', lambda: make_gtab(ndirs=32, nb0s=2, bval=1000)),
+])
+
+
+def _wm_mask(i, n_jobs):
+    return reconst.wm_mask_from_data(i['data'], i['gtab'], i['mask'],
+                                     n_jobs=n_jobs, cache=False)
+
+
+def _csd(i, n_jobs):
+    return reconst.csd(i['response'], i['data'], i['gtab'], i['mask'])
+
+
+def _sh2odf(i, n_jobs):
+    return reconst.sh2odf(i['sh'])
+
+
+def _calc_peaks(i, n_jobs):
+    return reconst.calc_peaks(i['odf'], n_jobs=n_jobs)
+
+
+def _sh_to_peaks(i, n_jobs):
+    return reconst.sh_to_peaks(i['sh'])
+
+
+def _sh_power(i, n_jobs):
+    return reconst.sh_power(i['sh'])
+
+
+def _calc_gfa(i, n_jobs):
+    return reconst.calc_gfa(i['odf'])
+
+
+# Benchmarked stages: name -> (inputs it needs, func(inputs, n_jobs)).
+# Inputs are computed once per phantom before any stage is timed.
+STAGES = OrderedDict([
+    ('wm_mask_from_data', (('data', 'gtab', 'mask'), _wm_mask)),
+    ('csd', (('response', 'data', 'gtab', 'mask'), _csd)),
+    ('sh2odf', (('sh',), _sh2odf)),
+    ('calc_peaks', (('odf',), _calc_peaks)),
+    ('sh_to_peaks', (('sh',), _sh_to_peaks)),
+    ('sh_power', (('sh',), _sh_power)),
+    ('calc_gfa', (('odf',), _calc_gfa)),
+])
+
+
+def phantom_inputs(scheme, size, needs=('data', 'gtab', 'mask'), seed=0):
+    # Phantom of size^3 voxels simulated with `scheme` and whatever derived
+    # inputs the stages need: the response of the phantom's fibres, its
+    # masked FODs ('sh', fit with the fixed response) and their ODFs
+    gtab = SCHEMES[scheme]()
+    data, mask, _, _ = multi_fiber_phantom(gtab, (size,) * 3, seed=seed)
+    inputs = {'gtab': gtab, 'data': data, 'mask': mask,
+              'response': (np.array(WM_EVALS), 100.)}
+    if 'sh' in needs or 'odf' in needs:
+        _, fod = reconst.csd(inputs['response'], data, gtab, mask)
+        inputs['sh'] = fod[mask]
+    if 'odf' in needs:
+        inputs['odf'] = reconst.sh2odf(inputs['sh'])
+    return inputs
+
+
+def measure(func, args=(), repeat=3):
+    # Runs func(*args) `repeat` times in a forked child process, so that
+    # its peak memory is not hidden by whatever the caller allocated
+    # before. Returns the best wall and CPU times (s), the peak RSS of the
+    # child and how far it rose above the RSS at the start of the call
+    # (MB).
+    ctx = mp.get_context('fork')
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_measure_child,
+                       args=(send, func, args, repeat))
+    proc.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = {'error': 'benchmark process died (exit code {})'.format(
+            proc.exitcode)}
+    proc.join()
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+
+def _measure_child(send, func, args, repeat):
+    try:
+        reset_peak_rss()
+        rss0 = proc_status('VmRSS')
+        walls, cpus = [], []
+        for i in range(max(repeat, 1)):
+            t0, c0 = time.perf_counter(), time.process_time()
+            func(*args)
+            walls.append(time.perf_counter() - t0)
+            cpus.append(time.process_time() - c0)
+            if i == 0:
+                # The first run sets the peak; later ones reuse the memory
+                peak = peak_rss() / 1024.**2
+        delta = (max(peak - rss0 / 1024.**2, 0) if rss0 is not None
+                 else float('nan'))
+        send.send({'wall': min(walls), 'cpu': min(cpus), 'walls': walls,
+                   'peak_rss': peak, 'delta_rss': delta})
+    except Exception:
+        send.send({'error': traceback.format_exc()})
+    finally:
+        send.close()
+
+
+def run_benchmarks(sizes=(12, 16, 24), schemes=('bvals_with_b0s',),
+                   stages=None, repeat=3, n_jobs=1, seed=0, history=None,
+                   verbose=True):
+    # Times every stage on a phantom of each size (voxels per side) and
+    # gradient scheme. Returns one record per (scheme, size, stage), which
+    # is also appended to the `history` file (JSON lines) when given.
+    if stages is None:
+        stages = list(STAGES)
+    needs = set(n for s in stages for n in STAGES[s][0])
+    run = environment()
+
+    records = []
+    for scheme in schemes:
+        for size in sizes:
+            inputs = phantom_inputs(scheme, size, needs, seed)
+            nvoxels = int(inputs['mask'].sum())
+            for stage in stages:
+                func = STAGES[stage][1]
+                result = measure(func, (inputs, n_jobs), repeat)
+                record = dict(run, stage=stage, scheme=scheme, size=size,
+                              nvoxels=nvoxels,
+                              nvolumes=int(inputs['data'].shape[-1]),
+                              n_jobs=n_jobs, repeat=repeat, seed=seed,
+                              voxels_per_sec=nvoxels / result['wall'],
+                              **result)
+                records.append(record)
+                if verbose:
+                    print('{} {} {}^3: {:.3g} s, {:.3g} voxels/s, '
+                          'peak {:.0f} MB'.format(
+                              scheme, stage, size, record['wall'],
+                              record['voxels_per_sec'], record['peak_rss']))
+                if history is not None:
+                    with open(history, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+    return records
+
+
+def environment():
+    # What a benchmark run was measured with, to tell runs apart and only
+    # compare like with like
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'run': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit,
+            'host': socket.gethostname(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def load_history(fn):
+    records = []
+    if os.path.exists(fn):
+        with open(fn) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+
+def _key(record):
+    return (record['stage'], record['scheme'], record['size'],
+            record['n_jobs'], record['host'])
+
+
+def report(records, history=()):
+    # Table of the records: time, throughput, scaling of the throughput
+    # with size (relative to the smallest phantom of the same stage and
+    # scheme), peak memory, and time relative to the best earlier run on
+    # the same host
+    runs = set(r['run'] for r in records)
+    best = {}
+    for r in history:
+        if r['run'] not in runs:
+            best[_key(r)] = min(best.get(_key(r), np.inf), r['wall'])
+    smallest = {}
+    for r in records:
+        k = (r['stage'], r['scheme'])
+        if k not in smallest or r['size'] < smallest[k]['size']:
+            smallest[k] = r
+
+    header = '{:<18} {:<15} {:>5} {:>8} {:>10} {:>11} {:>7} {:>9} {:>8} {:>8}'
+    row = ('{:<18} {:<15} {:>5} {:>8} {:>10.4g} {:>11.4g} {:>7.2f} {:>9.0f} '
+           '{:>8.1f} {:>8}')
+    lines = [header.format('stage', 'scheme', 'size', 'voxels', 'wall (s)',
+                           'voxels/s', 'scaling', 'peak (MB)', '+MB',
+                           'vs best')]
+    for r in records:
+        ref = smallest[(r['stage'], r['scheme'])]
+        prev = best.get(_key(r))
+        lines.append(row.format(
+            r['stage'], r['scheme'], r['size'], r['nvoxels'], r['wall'],
+            r['voxels_per_sec'], r['voxels_per_sec'] / ref['voxels_per_sec'],
+            r['peak_rss'], r['delta_rss'],
+            '{:.2f}x'.format(r['wall'] / prev) if prev is not None else '-'))
+    return '\n'.join(lines)
@@ -0,0 +1,139 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+
+# Directory of the result cache, or None to always recompute
+RESULT_CACHE_DIR = os.environ.get('HARDITOOLS_RESULT_CACHE')
+# Total size the cache is trimmed to, in bytes
+RESULT_CACHE_SIZE = int(os.environ.get('HARDITOOLS_RESULT_CACHE_SIZE',
+                                       4 * 1024**3))
+
+
+class ResultCache(object):
+    # Content-addressed on-disk store of pickled results. Entries are
+    # named after a hash of everything that produced them (see
+    # `content_key`), so a changed input can never return a stale result.
+    # The store is trimmed to `max_bytes` by evicting the least recently
+    # used entries (by mtime, which `get` refreshes).
+    def __init__(self, path, max_bytes=RESULT_CACHE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _fn(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def __contains__(self, key):
+        return os.path.exists(self._fn(key))
+
+    def get(self, key, default=None):
+        fn = self._fn(key)
+        try:
+            with open(fn, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+        os.utime(fn)
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.path, exist_ok=True)
+        fn = self._fn(key)
+        tmpfn = '{}.{}.tmp'.format(fn, os.getpid())
+        try:
+            with open(tmpfn, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfn, fn)
+        finally:
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.path, name))
+
+
+def default_cache():
+    if RESULT_CACHE_DIR is None:
+        return None
+    return ResultCache(RESULT_CACHE_DIR)
+
+
+def content_key(*parts, mask=None, chunk_size=100000):
+    # sha1 over `parts`: arrays (by dtype, shape and contents), gradient
+    # tables (bvals, bvecs, b0 threshold), and anything else by repr. With
+    # `mask`, arrays of shape mask.shape + (n,) only contribute their masked
+    # voxels, read a chunk at a time.
+    h = hashlib.sha1()
+    for part in parts:
+        _update(h, part, mask, chunk_size)
+    return h.hexdigest()
+
+
+def _update(h, part, mask, chunk_size):
+    if hasattr(part, 'bvals') and hasattr(part, 'bvecs'):
+        h.update(b'gtab')
+        for a in [part.bvals, part.bvecs]:
+            _update(h, np.asarray(a, dtype='float64'), None, chunk_size)
+        h.update(repr(part.b0_threshold).encode())
+    elif isinstance(part, np.ndarray):
+        h.update('{}{}'.format(part.dtype.str, part.shape).encode())
+        if (mask is not None and part.ndim > mask.ndim and
+                part.shape[:mask.ndim] == mask.shape):
+            voxels = np.flatnonzero(mask)
+            h.update(b'masked')
+            for start in range(0, voxels.size, chunk_size):
+                ijk = np.unravel_index(voxels[start:start + chunk_size],
+                                       mask.shape)
+                h.update(np.ascontiguousarray(part[ijk]))
+        else:
+            h.update(np.ascontiguousarray(part))
+    elif isinstance(part, (list, tuple)):
+        h.update('{}{}'.format(type(part).__name__, len(part)).encode())
+        for p in part:
+            _update(h, p, mask, chunk_size)
+    elif isinstance(part, dict):
+        _update(h, sorted(part.items()), mask, chunk_size)
+    else:
+        h.update(repr(part).encode())
+
+
+def cached_call(name, func, key_parts, mask=None, cache=None):
+    # func(), looked up in (and stored to) `cache` under the content key of
+    # `name` and `key_parts`. cache=None uses the RESULT_CACHE_DIR cache if
+    # it is set, False always calls func.
+    if cache is None:
+        cache = default_cache()
+    if cache is None or cache is False:
+        return func()
+
+    key = '{}_{}'.format(name, content_key(name, key_parts, mask=mask))
+    missing = object()
+    value = cache.get(key, missing)
+    if value is missing:
+        value = func()
+        cache.put(key, value)
+    return value
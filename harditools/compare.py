@@ -0,0 +1,222 @@
+import numpy as np
+from .utils import percdiff, ang_distance, MaskedVolume
+from .reconst import sh_power
+from .stats import Histogram, bin_edges
+from .angles import matched_angles
+
+
+class Metric(object):
+    # A per-voxel difference between a candidate and the reference.
+    # `func(ref, cand)` takes dicts of chunk arrays holding `fields` and
+    # returns a (n,) or (n, ncols) array of differences. `bins` are the
+    # histogram edges, or a number of equal bins spanning the range of each
+    # candidate's differences. `select(chunks)` optionally restricts the
+    # voxels used, given the chunks of every dataset (reference first).
+    def __init__(self, fields, func, bins, select=None):
+        self.fields = fields
+        self.func = func
+        self.bins = bins
+        self.select = select
+
+
+def _percent(field):
+    def func(ref, cand):
+        return percdiff(cand[field], ref[field])
+    return func
+
+
+def _num_peaks(chunk):
+    return (chunk['peak_values'] != 0).sum(axis=-1)
+
+
+def _numpeaks_diff(ref, cand):
+    return _num_peaks(cand) - _num_peaks(ref)
+
+
+def _greatestpeak_diff(ref, cand):
+    return percdiff(cand['peak_values'].max(axis=-1),
+                    ref['peak_values'].max(axis=-1))
+
+
+def _exactly_two_peaks(chunks):
+    # Voxels where every dataset has exactly two peaks
+    return np.logical_and.reduce([_num_peaks(c) == 2 for c in chunks])
+
+
+def _first_two_angles(ref, cand):
+    return ang_distance(ref['peak_dirs'][:, :2].reshape(-1, 3),
+                        cand['peak_dirs'][:, :2].reshape(-1, 3))
+
+
+def _matched_angles(ref, cand):
+    # All peaks of every voxel, optimally paired
+    return matched_angles(ref['peak_dirs'], cand['peak_dirs'])
+
+
+def _power_diff(ref, cand):
+    return (cand['power'] - ref['power']) / ref['power'] * 100
+
+
+def _pdd_angle(ref, cand):
+    return ang_distance(ref['pdd'], cand['pdd'])
+
+
+METRICS = {
+    'gfa': Metric(('gfa',), _percent('gfa'), 512),
+    'numpeaks': Metric(('peak_values',), _numpeaks_diff,
+                       np.arange(-4.5, 5.5)),
+    'greatestpeak': Metric(('peak_values',), _greatestpeak_diff, 512),
+    'angle': Metric(('peak_dirs', 'peak_values'), _first_two_angles,
+                    np.linspace(0, 90, 257), select=_exactly_two_peaks),
+    'matched_angle': Metric(('peak_dirs',), _matched_angles,
+                            np.linspace(0, 90, 257)),
+    'power': Metric(('power',), _power_diff, 512),
+    'fa': Metric(('fa',), _percent('fa'), 512),
+    'pdd': Metric(('pdd',), _pdd_angle, np.linspace(0, 90, 513)),
+}
+
+
+class Comparison(object):
+    # Result of `compare`: hists[metric][i] is the Histogram of the
+    # differences of candidate i, or a list of Histograms (one per column,
+    # e.g. SH band) for metrics with several columns
+    def __init__(self, names, hists):
+        self.names = names
+        self.hists = hists
+
+    def __getitem__(self, metric):
+        return self.hists[metric]
+
+
+def peaks_dataset(peaks, sh=None):
+    # Fields of a Peaks object (and optionally its SH coefficients) in the
+    # form used by `compare`
+    dataset = {field: getattr(peaks, field) for field in peaks._fields}
+    if sh is not None:
+        dataset['sh'] = sh
+    return dataset
+
+
+def compare(reference, candidates, mask, metrics=('gfa', 'numpeaks',
+                                                  'greatestpeak', 'angle'),
+            names=None, bins=None, chunk_size=100000):
+    # Accumulates every metric for every candidate against `reference`
+    # over the voxels in `mask`, a chunk at a time. Datasets are dicts of
+    # arrays (see peaks_dataset) that are either volumes of mask.shape, or
+    # hold only the masked voxels in the order of mask[mask]. 'power' is
+    # computed from 'sh' per chunk when a dataset has no 'power' field.
+    # Metrics binned by a number of bins take a first pass over the voxels
+    # to find the range of their differences. `bins` overrides the bins of
+    # metrics by name.
+    if bins is None:
+        bins = {}
+    if names is None:
+        names = ['{}'.format(i) for i in range(len(candidates))]
+
+    datasets = [_masked_fields(dataset, mask) for dataset
+                in [reference] + list(candidates)]
+    metrics = [(name, METRICS[name], bins.get(name, METRICS[name].bins))
+               for name in metrics]
+
+    edges = {name: [b] * len(candidates) for name, _, b in metrics
+             if np.ndim(b) > 0}
+    auto = [(name, metric) for name, metric, b in metrics if np.ndim(b) == 0]
+    if auto:
+        ranges = {name: [None] * len(candidates) for name, _ in auto}
+        for name, i, diff in _diffs(datasets, mask, auto, chunk_size):
+            ranges[name][i] = _update_range(ranges[name][i], diff)
+        for name, metric, b in metrics:
+            if name in ranges:
+                edges[name] = [_range_edges(r, b) for r in ranges[name]]
+
+    hists = {name: [None] * len(candidates) for name, _, _ in metrics}
+    metrics = [(name, metric) for name, metric, _ in metrics]
+    for name, i, diff in _diffs(datasets, mask, metrics, chunk_size):
+        _accumulate(hists[name], i, diff, edges[name][i])
+
+    return Comparison(names, hists)
+
+
+def _diffs(datasets, mask, metrics, chunk_size):
+    # Yields (metric name, candidate index, differences) for every chunk
+    fields = set(field for _, metric in metrics for field in metric.fields)
+    voxels = np.flatnonzero(mask)
+    for start in range(0, voxels.size, chunk_size):
+        stop = min(start + chunk_size, voxels.size)
+        ijk = np.unravel_index(voxels[start:stop], mask.shape)
+
+        chunks = [_chunk(dataset, fields, mask, ijk, start, stop)
+                  for dataset in datasets]
+        ref = chunks[0]
+
+        for name, metric in metrics:
+            rows = slice(None)
+            if metric.select is not None:
+                rows = metric.select(chunks)
+            ref_rows = {f: ref[f][rows] for f in metric.fields}
+
+            for i, cand in enumerate(chunks[1:]):
+                yield name, i, metric.func(
+                    ref_rows, {f: cand[f][rows] for f in metric.fields})
+
+
+def _update_range(current, diff):
+    # (min, max) of the finite differences so far, per column for 2D ones
+    finite = np.isfinite(diff)
+    lo = np.where(finite, diff, np.inf).min(axis=0)
+    hi = np.where(finite, diff, -np.inf).max(axis=0)
+    if current is not None:
+        lo, hi = np.minimum(lo, current[0]), np.maximum(hi, current[1])
+    return lo, hi
+
+
+def _range_edges(current, nbins):
+    if current is None:
+        return bin_edges(np.nan, np.nan, nbins)
+    lo, hi = current
+    if np.ndim(lo) == 0:
+        return bin_edges(lo, hi, nbins)
+    return [bin_edges(l, h, nbins) for l, h in zip(lo, hi)]
+
+
+def _chunk(dataset, fields, mask, ijk, start, stop):
+    chunk = {}
+    for field in fields:
+        if field == 'power' and 'power' not in dataset:
+            chunk[field] = sh_power(_rows(dataset['sh'], mask, ijk, start, stop))
+        else:
+            chunk[field] = _rows(dataset[field], mask, ijk, start, stop)
+    return chunk
+
+
+def _masked_fields(dataset, mask):
+    # MaskedVolumes over the same mask already hold the rows in order
+    dataset = dict(dataset)
+    for field, data in dataset.items():
+        if isinstance(data, MaskedVolume):
+            if data.mask is mask or np.array_equal(data.mask, mask):
+                dataset[field] = data.data
+            else:
+                dataset[field] = np.asarray(data)
+    return dataset
+
+
+def _rows(data, mask, ijk, start, stop):
+    if data.shape[:mask.ndim] == mask.shape:
+        return np.asarray(data[ijk])
+    return np.asarray(data[start:stop])
+
+
+def _accumulate(hists, i, diff, bins):
+    # `bins` may be a list of edges, one per column of a 2D diff
+    if diff.ndim == 1:
+        if hists[i] is None:
+            hists[i] = Histogram(bins)
+        hists[i].add(diff)
+    else:
+        if hists[i] is None:
+            if not isinstance(bins, list):
+                bins = [bins] * diff.shape[1]
+            hists[i] = [Histogram(b) for b in bins]
+        for hist, column in zip(hists[i], diff.T):
+            hist.add(column)
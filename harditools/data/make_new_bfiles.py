@@ -1,24 +1,15 @@
 import numpy as np
-from dipy.core.gradients import gradient_table
+import harditools as hd
 
 bvalfn = 'bvals'
 bvecfn = 'bvecs'
 
-gtab = gradient_table(bvalfn, bvecfn)
+# The original files hold one averaged b0 followed by the 144 DWIs. The data
+# has all 16 b0s, acquired as 1 b0 every 9 DWIs.
+gtab = hd.load_gtab(bvalfn=bvalfn, bvecfn=bvecfn)
 
-bvals = 3000 * np.ones(160, dtype=np.int)
-bvals[::10] = 0
+bvals = np.r_[np.zeros(16), 3000 * np.ones(144)]
+bvecs = np.r_[np.zeros((16, 3)), gtab.bvecs[1:]]
 
-bvecs = np.insert(gtab.bvecs[1:], np.arange(
-    0, gtab.bvecs[1:].shape[0], 9), [0, 0, 0], axis=0)
-
-
-with open('./bvals_with_b0s', 'w') as f:
-    for bval in bvals:
-        f.write('{} '.format(bval))
-
-with open('./bvecs_with_b0s', 'w') as f:
-    for i in range(3):
-        for val in bvecs[:, i]:
-            f.write('{} '.format(val))
-        f.write('\n')
+scheme = hd.GradientScheme(bvals, bvecs).interleave_b0s(every=9)
+scheme.save('./bvals_with_b0s', './bvecs_with_b0s')
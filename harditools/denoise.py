@@ -0,0 +1,185 @@
+import os
+import numpy as np
+from multiprocessing import Pool, RawArray
+from numpy.lib.stride_tricks import as_strided
+from .utils import load_data
+from .instrument import instrumented
+
+
+def mppca(data, extent=5, mask=None, slab=8, n_jobs=1, dtype='float32',
+          batch_size=256):
+    # Marchenko-Pastur PCA denoising of a 4D image [Veraart2016], as done
+    # by MRtrix3's dwidenoise. Returns the denoised image and the noise
+    # level (sigma) map. See mppca_sweep for the arguments.
+    return mppca_sweep(data, [extent], mask, slab, n_jobs, dtype,
+                       batch_size)[extent]
+
+
+@instrumented(voxels=('mask', 'data'))
+def mppca_sweep(data, extents=(5, 7, 9), mask=None, slab=8, n_jobs=1,
+                dtype='float32', batch_size=256):
+    # MP-PCA with several cubic kernel `extents` in one pass: the data is
+    # read once per z-slab (plus the overlap the largest kernel needs) and
+    # the patches of every extent are strided views into it. `data` is a
+    # 4D array, which is copied once into memory shared by the workers, or
+    # an uncompressed NIfTI filename, which each worker reads a slab at a
+    # time (through its memory map). Voxels outside `mask` are copied through with sigma 0.
+    # Slabs of `slab` planes are denoised by a pool of n_jobs processes
+    # (None: all cores). Returns {extent: (denoised, sigma)}.
+    #
+    # As in dwidenoise, the kernel is centered on each voxel and shifted
+    # inwards at the edges of the image, and only the center voxel is
+    # reconstructed, from the components above the MP noise threshold.
+    if isinstance(data, str):
+        img, _ = load_data(data, cache=False)
+        shape = img.shape
+    else:
+        shape = data.shape
+    extents = list(extents)
+    for k in extents:
+        if k % 2 == 0 or any(k > s for s in shape[:3]):
+            raise ValueError('Extent {} must be odd and fit in the image '
+                             'shape {}'.format(k, shape[:3]))
+    if mask is None:
+        mask = np.ones(shape[:3], dtype='bool')
+
+    out = {k: (np.zeros(shape, dtype=dtype), np.zeros(shape[:3], dtype=dtype))
+           for k in extents}
+
+    slabs = [(z0, min(z0 + slab, shape[2]))
+             for z0 in range(0, shape[2], slab)]
+    args = [(z0, z1, mask[:, :, z0:z1]) for z0, z1 in slabs]
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(min(n_jobs, len(slabs)), 1)
+
+    if n_jobs > 1:
+        if not isinstance(data, str):
+            data = _share(data)
+        initargs = (data, shape, extents, dtype, batch_size)
+        with Pool(n_jobs, initializer=_init_worker,
+                  initargs=initargs) as pool:
+            for (z0, z1), result in zip(slabs, pool.imap(_slab_worker, args)):
+                _store(out, z0, z1, result)
+    else:
+        _init_worker(data, shape, extents, dtype, batch_size)
+        for (z0, z1), arg in zip(slabs, args):
+            _store(out, z0, z1, _slab_worker(arg))
+        _worker.clear()
+
+    return out
+
+
+def _store(out, z0, z1, result):
+    for k, (denoised, sigma) in result.items():
+        out[k][0][:, :, z0:z1] = denoised
+        out[k][1][:, :, z0:z1] = sigma
+
+
+def _share(data):
+    shared = RawArray('b', max(data.nbytes, 1))
+    view = np.frombuffer(shared, data.dtype, data.size).reshape(data.shape)
+    view[...] = data
+    return shared, data.dtype.str
+
+
+_worker = {}
+
+
+def _init_worker(data, shape, extents, dtype, batch_size):
+    if isinstance(data, tuple):
+        shared, data_dtype = data
+        data = np.frombuffer(shared, data_dtype,
+                             int(np.prod(shape))).reshape(shape)
+    _worker.update(data=data, shape=shape, extents=extents, dtype=dtype,
+                   batch_size=batch_size)
+
+
+def _slab_worker(args):
+    z0, z1, mask = args
+    data, shape = _worker['data'], _worker['shape']
+    extents = _worker['extents']
+
+    # Planes every kernel centered (or shifted inwards) in [z0, z1) reads
+    kmax = max(extents)
+    zlo = max(min(z0 - kmax // 2, shape[2] - kmax), 0)
+    zhi = min(max(z1 + kmax // 2, kmax), shape[2])
+    if isinstance(data, str):
+        _, block = load_data(data, slicer=np.s_[:, :, zlo:zhi], cache=False)
+    else:
+        block = data[:, :, zlo:zhi]
+    block = np.asarray(block, dtype='float64')
+
+    voxels = np.array(np.nonzero(mask)).T + [0, 0, z0]
+    result = {}
+    for k in extents:
+        denoised = np.array(block[:, :, z0 - zlo:z1 - zlo],
+                            dtype=_worker['dtype'])
+        sigma = np.zeros(mask.shape, dtype=_worker['dtype'])
+        windows = _windows(block, k)
+        for start in range(0, voxels.shape[0], _worker['batch_size']):
+            xyz = voxels[start:start + _worker['batch_size']]
+            values, sigmas = _mppca_voxels(windows, xyz, k, zlo, shape)
+            i, j, l = (xyz - [0, 0, z0]).T
+            denoised[i, j, l] = values
+            sigma[i, j, l] = sigmas
+        result[k] = (denoised, sigma)
+    return result
+
+
+def _windows(block, k):
+    # (X-k+1, Y-k+1, Z-k+1, k, k, k, n) view of every k^3 patch of block
+    X, Y, Z, n = block.shape
+    s = block.strides
+    return as_strided(block, shape=(X - k + 1, Y - k + 1, Z - k + 1,
+                                    k, k, k, n),
+                      strides=s[:3] + s, writeable=False)
+
+
+def _mppca_voxels(windows, xyz, k, zlo, shape):
+    # Denoised signal and sigma of the center voxels `xyz` (image
+    # coordinates), each from its own k^3 patch
+    h = k // 2
+    starts = np.clip(xyz - h, 0, np.array(shape[:3]) - k)
+    center = xyz - starts
+    starts = starts - [0, 0, zlo]
+
+    X = windows[starts[:, 0], starts[:, 1], starts[:, 2]]
+    X = X.reshape(X.shape[0], k**3, -1)
+    c = (center[:, 0] * k + center[:, 1]) * k + center[:, 2]
+    x = X[np.arange(X.shape[0]), c]
+
+    nvox, m = X.shape[1], X.shape[2]
+    r, q = min(m, nvox), max(m, nvox)
+    if m <= nvox:
+        gram = np.matmul(X.transpose(0, 2, 1), X)
+    else:
+        gram = np.matmul(X, X.transpose(0, 2, 1))
+    s, V = np.linalg.eigh(gram)
+
+    # MP threshold with dwidenoise's default Exp2 estimator (Cordero-Grande
+    # et al. 2019, gamma = p / (q - (r - p))): the largest number of
+    # components p whose eigenvalues fit the MP distribution of pure noise
+    lam = np.maximum(s, 0) / q
+    p = np.arange(1, r + 1)
+    gam = p / (q - (r - p))
+    sigsq1 = np.cumsum(lam, axis=1) / p
+    sigsq2 = (lam - lam[:, :1]) / (4 * np.sqrt(gam))
+    noise = sigsq2 < sigsq1
+    cutoff = np.where(noise.any(axis=1),
+                      r - np.argmax(noise[:, ::-1], axis=1), 0)
+    sigma2 = np.where(cutoff > 0,
+                      sigsq1[np.arange(s.shape[0]), np.maximum(cutoff, 1) - 1],
+                      0)
+
+    keep = (p[None, :] > cutoff[:, None]).astype('float64')
+    if m <= nvox:
+        coef = np.einsum('bij,bi->bj', V, x) * keep
+        values = np.einsum('bij,bj->bi', V, coef)
+    else:
+        coef = V[np.arange(V.shape[0]), c] * keep
+        values = np.einsum('bni,bn->bi', X,
+                           np.einsum('bnj,bj->bn', V, coef))
+
+    return values, np.sqrt(sigma2)
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import inspect
+import logging
+import resource
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Sinks every finished stage record is sent to. Instrumentation is off
+# (and costs one list check per call) while this is empty.
+_sinks = []
+_local = threading.local()
+
+
+def enable(*sinks):
+    # Starts sending stage records to `sinks` (default: a LogSink). A sink
+    # is any callable taking the record dict. Returns the sinks.
+    if not sinks:
+        sinks = (LogSink(),)
+    _sinks.extend(sinks)
+    return sinks
+
+
+def disable():
+    del _sinks[:]
+
+
+def enabled():
+    return bool(_sinks)
+
+
+@contextmanager
+def stage(name, **info):
+    # Measures the enclosed block: wall and CPU time (including child
+    # processes that finish inside it), bytes read from and written to
+    # storage by the process, and its peak RSS. Yields the record, so the block can add
+    # fields such as `voxels`; `info` is added up front. Stages nest, and
+    # each record names its parent.
+    if not _sinks:
+        yield {}
+        return
+
+    stack = _stack()
+    record = OrderedDict(name=name,
+                         parent=stack[-1]['name'] if stack else None)
+    record.update(info)
+
+    # The peak so far belongs to the enclosing stage, then it is reset so
+    # this stage sees its own
+    hwm = peak_rss()
+    if stack:
+        stack[-1]['_peak'] = max(stack[-1]['_peak'], hwm)
+    reset = reset_peak_rss()
+    record['_peak'] = 0 if reset else hwm
+
+    io0 = _io()
+    cpu0 = _cpu()
+    record['start'] = time.time()
+    t0 = time.perf_counter()
+    stack.append(record)
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['wall'] = time.perf_counter() - t0
+        record['cpu'] = _cpu() - cpu0
+        io1 = _io()
+        record['read_bytes'] = io1[0] - io0[0]
+        record['write_bytes'] = io1[1] - io0[1]
+        stack.pop()
+        peak = max(record.pop('_peak'), peak_rss())
+        record['peak_rss'] = peak
+        if stack:
+            stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+        record['pid'] = os.getpid()
+        _emit(record)
+
+
+def instrumented(name=None, voxels=None, info=None):
+    # Decorator running each call of a function in a `stage` (named after
+    # the function by default). `voxels` names the argument(s) the voxel
+    # count is taken from: the first one that is an array, counted as a
+    # mask if it is boolean and by all axes but the last otherwise.
+    # info(args, result) returns more fields for the record from the
+    # arguments (a dict by parameter name, defaults filled in) and result.
+    if isinstance(voxels, str):
+        voxels = (voxels,)
+
+    def decorate(func):
+        stage_name = name if name is not None else func.__name__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with stage(stage_name) as record:
+                result = func(*args, **kwargs)
+                if voxels is not None or info is not None:
+                    bound = signature.bind(*args, **kwargs)
+                    bound.apply_defaults()
+                    arguments = bound.arguments
+                    if voxels is not None:
+                        record['voxels'] = _count_voxels(
+                            [arguments[v] for v in voxels])
+                    if info is not None:
+                        record.update(info(arguments, result))
+            return result
+        return wrapper
+    return decorate
+
+
+def proc_status(field):
+    # Memory field of /proc/self/status (e.g. 'VmRSS') in bytes, None where
+    # there is no such file (not Linux)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss():
+    # Peak resident memory in bytes: VmHWM on Linux, ru_maxrss otherwise
+    hwm = proc_status('VmHWM')
+    if hwm is None:
+        hwm = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return hwm
+
+
+def reset_peak_rss():
+    # Resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _count_voxels(candidates):
+    for a in candidates:
+        shape = getattr(a, 'shape', None)
+        if shape is None:
+            continue
+        if a.dtype == bool:
+            return int(a.sum())
+        n = 1
+        for s in shape[:-1]:
+            n *= s
+        return n
+    return None
+
+
+def _emit(record):
+    for sink in list(_sinks):
+        sink(record)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _cpu():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime + children.ru_utime +
+            children.ru_stime)
+
+
+def _io():
+    # Bytes the process made the kernel read from and write to storage
+    # (Linux), whether through system calls or page faults on memory maps.
+    # Reads served from the page cache are not counted, nor are the reads
+    # of /proc this module makes itself (which rchar/wchar would include).
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _size(n):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            return '{:.3g} {}'.format(n, unit)
+        n /= 1024.
+    return '{:.3g} TB'.format(n)
+
+
+class LogSink(object):
+    # Logs one line per stage to the 'harditools' logger (or `logger`)
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logging.getLogger('harditools') if logger is None \
+            else logger
+        self.level = level
+
+    def __call__(self, record):
+        if not self.logger.hasHandlers():
+            # Logging was not configured (e.g. HARDITOOLS_INSTRUMENT=log on
+            # a plain script), which would drop the lines: print them to
+            # stderr instead
+            self.logger.addHandler(logging.StreamHandler())
+            if not self.logger.isEnabledFor(self.level):
+                self.logger.setLevel(self.level)
+        msg = '{}: {:.3g} s wall, {:.3g} s cpu, peak {}, read {}, wrote {}'
+        msg = msg.format(record['name'], record['wall'], record['cpu'],
+                         _size(record['peak_rss']),
+                         _size(record['read_bytes']),
+                         _size(record['write_bytes']))
+        if record.get('voxels'):
+            msg += ', {} voxels ({:.3g}/s)'.format(
+                record['voxels'], record['voxels'] / max(record['wall'], 1e-9))
+        if 'error' in record:
+            msg += ', failed with {}'.format(record['error'])
+        self.logger.log(self.level, msg)
+
+
+class JsonLinesSink(object):
+    # Appends each record to `fn` as a line of JSON. The file is opened per
+    # record, so processes can share it.
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, record):
+        with open(self.fn, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+class Summary(object):
+    # In-memory totals per stage name: calls, wall and CPU time, bytes read
+    # and written, voxels, and the largest peak RSS
+    FIELDS = ('wall', 'cpu', 'read_bytes', 'write_bytes', 'voxels')
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def __call__(self, record):
+        totals = self.stages.setdefault(record['name'], OrderedDict(
+            [('calls', 0)] + [(f, 0) for f in self.FIELDS] +
+            [('peak_rss', 0)]))
+        totals['calls'] += 1
+        for f in self.FIELDS:
+            totals[f] += record.get(f) or 0
+        totals['peak_rss'] = max(totals['peak_rss'], record['peak_rss'])
+
+    def clear(self):
+        self.stages.clear()
+
+    def table(self):
+        header = '{:<24} {:>6} {:>10} {:>10} {:>10} {:>10} {:>12} {:>10}'
+        row = '{:<24} {:>6} {:>10.4g} {:>10.4g} {:>10} {:>10} {:>12} {:>10}'
+        lines = [header.format('stage', 'calls', 'wall (s)', 'cpu (s)',
+                               'read', 'written', 'voxels', 'peak')]
+        for name, t in self.stages.items():
+            lines.append(row.format(name, t['calls'], t['wall'], t['cpu'],
+                                    _size(t['read_bytes']),
+                                    _size(t['write_bytes']),
+                                    t['voxels'] or '-',
+                                    _size(t['peak_rss'])))
+        return '\n'.join(lines)
+
+
+# HARDITOOLS_INSTRUMENT=log logs every stage, any other value is a JSON
+# lines file to append the records to
+_env = os.environ.get('HARDITOOLS_INSTRUMENT')
+if _env:
+    enable(LogSink() if _env == 'log' else JsonLinesSink(_env))
@@ -0,0 +1,84 @@
+import numpy as np
+from dipy.core.gradients import gradient_table
+from dipy.core.sphere import disperse_charges, HemiSphere
+
+# Diffusivities (mm^2/s) of the phantom compartments
+WM_EVALS = (1.7e-3, 0.3e-3, 0.3e-3)
+GM_MD = 0.8e-3
+CSF_MD = 3.0e-3
+
+
+def make_gtab(ndirs=144, nb0s=16, bval=3000, seed=0):
+    # Single shell scheme of `ndirs` electrostatically dispersed directions
+    # with a b0 before every ndirs/nb0s DWIs, like the acquired one
+    rng = np.random.RandomState(seed)
+    theta = np.pi * rng.rand(ndirs)
+    phi = 2 * np.pi * rng.rand(ndirs)
+    hsph, _ = disperse_charges(HemiSphere(theta=theta, phi=phi), 5000)
+
+    every = max(ndirs // max(nb0s, 1), 1)
+    bvals, bvecs = [], []
+    for i, v in enumerate(hsph.vertices):
+        if i % every == 0 and len(bvals) - i < nb0s:
+            # b0s so far: len(bvals) - i
+            bvals.append(0)
+            bvecs.append([0, 0, 0])
+        bvals.append(bval)
+        bvecs.append(v)
+    return gradient_table(np.array(bvals, dtype='float64'), np.array(bvecs))
+
+
+def multi_fiber_phantom(gtab, shape=(16, 16, 16), max_fibers=3, snr=30,
+                        S0=100., seed=0, dtype='float32'):
+    # Deterministic synthetic DWI volume: an ellipsoidal "brain" of white
+    # matter voxels with 1 to `max_fibers` crossing tensor compartments at
+    # random orientations, plus grey matter and CSF (isotropic) voxels, in
+    # Rician noise of the given SNR. Returns (data, mask, wm, dirs), where
+    # dirs is (shape + (max_fibers, 3)) with zero rows for absent fibres.
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape],
+                       indexing='ij')
+    r = np.sqrt(sum(g**2 for g in grid))
+    mask = r <= 0.95
+    wm = mask & (r <= 0.7)
+    csf = mask & (r <= 0.15)
+    wm &= ~csf
+    gm = mask & ~wm & ~csf
+
+    n = int(np.prod(shape))
+    nfibers = rng.randint(1, max_fibers + 1, size=n)
+    dirs = rng.randn(n, max_fibers, 3)
+    dirs /= np.linalg.norm(dirs, axis=-1, keepdims=True)
+    present = np.arange(max_fibers) < nfibers[:, None]
+    dirs *= present[..., None]
+    fractions = rng.rand(n, max_fibers) * present + present
+    fractions /= fractions.sum(axis=1, keepdims=True)
+
+    bvals = gtab.bvals
+    bvecs = np.nan_to_num(gtab.bvecs)
+    data = np.zeros((n, bvals.size), dtype='float64')
+
+    # Tensor with eigenvalues (l1, l2, l2) along d: g'Dg = l2 + (l1-l2)(g.d)^2
+    flat_wm = wm.ravel()
+    l1, l2, _ = WM_EVALS
+    for start in range(0, n, 10000):
+        sel = slice(start, start + 10000)
+        cos2 = np.einsum('nfk,mk->nfm', dirs[sel], bvecs)**2
+        adc = l2 + (l1 - l2) * cos2
+        signal = np.einsum('nf,nfm->nm', fractions[sel],
+                           np.exp(-bvals * adc))
+        data[sel] = np.where(flat_wm[sel, None], signal, 0)
+
+    data[gm.ravel()] = np.exp(-bvals * GM_MD)
+    data[csf.ravel()] = np.exp(-bvals * CSF_MD)
+    data *= S0
+
+    sigma = S0 / snr
+    data = np.sqrt((data + sigma * rng.randn(*data.shape))**2 +
+                   (sigma * rng.randn(*data.shape))**2)
+    data[~mask.ravel()] = np.abs(sigma * rng.randn(n - mask.sum(),
+                                                  bvals.size))
+
+    dirs[~flat_wm] = 0
+    return (data.reshape(shape + (-1,)).astype(dtype), mask, wm,
+            dirs.reshape(shape + (max_fibers, 3)))
@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from .utils import file_hash
+
+
+class Stage(object):
+    # One step of a Pipeline: func(*dep_results, **params). `files` are the
+    # input files it reads, `outputs` the files it writes. `load(*outputs)`
+    # rebuilds its result from those files, so a stage that is up to date
+    # does not have to run to feed a later one.
+    def __init__(self, name, func, deps=(), files=(), outputs=(),
+                 params=None, load=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.files = tuple(files)
+        self.outputs = tuple(outputs)
+        self.params = params if params is not None else {}
+        self.load = load
+
+
+class Pipeline(object):
+    # Small DAG runner. Each stage gets a fingerprint from its name,
+    # parameters, input files (mtime and size, or contents with
+    # hash_files) and the fingerprints of its dependencies. A stage whose
+    # fingerprint matches the last successful run and whose outputs exist
+    # is skipped. Results are passed between stages in memory; a skipped
+    # stage is loaded from its outputs, or rerun if it has no loader, only
+    # when a stage that runs needs it. Fingerprints are kept in `state_fn`
+    # (JSON) and saved after every stage.
+    def __init__(self, name, state_fn=None, hash_files=False, verbose=True):
+        self.name = name
+        if state_fn is None:
+            state_fn = '.{}_pipeline.json'.format(name)
+        self.state_fn = state_fn
+        self.hash_files = hash_files
+        self.verbose = verbose
+        # Insertion order is a topological order, since a stage can only
+        # depend on stages added before it
+        self.stages = OrderedDict()
+        self.results = {}
+
+    def add(self, name, func, deps=(), files=(), outputs=(), params=None,
+            load=None):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError('Stage {} depends on unknown stage {}'.format(
+                    name, dep))
+        self.stages[name] = Stage(name, func, deps, files, outputs, params,
+                                  load)
+        return self
+
+    def fingerprints(self):
+        fps = {}
+        for stage in self.stages.values():
+            h = hashlib.sha1()
+            h.update(repr((stage.name, sorted(stage.params.items()),
+                           stage.outputs)).encode())
+            for fn in stage.files:
+                h.update(self._signature(fn).encode())
+            for dep in stage.deps:
+                h.update(fps[dep].encode())
+            fps[stage.name] = h.hexdigest()
+        return fps
+
+    def _signature(self, fn):
+        if not os.path.exists(fn):
+            return '{}:missing'.format(fn)
+        if self.hash_files:
+            return '{}:{}'.format(fn, file_hash(fn))
+        stat = os.stat(fn)
+        return '{}:{}:{}'.format(fn, stat.st_mtime_ns, stat.st_size)
+
+    def stale(self, force=False):
+        # Names of the stages that have to run
+        state = self._load_state()
+        fps = self.fingerprints()
+        return [s.name for s in self.stages.values()
+                if force or state.get(s.name) != fps[s.name] or
+                not all(os.path.exists(fn) for fn in s.outputs)]
+
+    def run(self, targets=None, force=False):
+        # Runs the stale stages among `targets` (default: all stages) and
+        # their dependencies. Returns {stage: 'ran' or 'skipped'}.
+        if targets is None:
+            targets = list(self.stages)
+        needed = self._closure(targets)
+
+        state = self._load_state()
+        self._fps = self.fingerprints()
+        stale = set(self.stale(force))
+        status = {}
+        for name in self.stages:
+            if name not in needed:
+                continue
+            if name in stale:
+                self._run(name, state)
+                status[name] = 'ran'
+            else:
+                status[name] = 'skipped'
+                self._log('{}: {} up to date'.format(self.name, name))
+        return status
+
+    def result(self, name):
+        # Result of a stage: in memory, loaded from its outputs, or computed
+        if name not in self.results:
+            stage = self.stages[name]
+            if stage.load is not None and stage.outputs and \
+                    all(os.path.exists(fn) for fn in stage.outputs):
+                self.results[name] = stage.load(*stage.outputs)
+            else:
+                self._fps = self.fingerprints()
+                self._run(name, self._load_state())
+        return self.results[name]
+
+    def _run(self, name, state):
+        stage = self.stages[name]
+        args = [self.result(dep) for dep in stage.deps]
+        self._log('{}: running {}'.format(self.name, name))
+        for fn in stage.outputs:
+            outdir = os.path.dirname(fn)
+            if outdir:
+                os.makedirs(outdir, exist_ok=True)
+        self.results[name] = stage.func(*args, **stage.params)
+
+        state[name] = self._fps[name]
+        self._save_state(state)
+
+    def _closure(self, targets):
+        needed = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].deps)
+        return needed
+
+    def _load_state(self):
+        if os.path.exists(self.state_fn):
+            with open(self.state_fn) as f:
+                return json.load(f)
+        return {}
+
+    def _save_state(self, state):
+        tmpfn = '{}.{}.tmp'.format(self.state_fn, os.getpid())
+        with open(tmpfn, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(tmpfn, self.state_fn)
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
+
+
+def run_datasets(build, names, n_jobs=None, targets=None, force=False):
+    # Builds a pipeline per dataset with build(name) and runs them
+    # concurrently, one process per dataset. `build` must be picklable
+    # (e.g. a module level function). Returns {name: run status}.
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(min(n_jobs, len(names)), 1)
+
+    args = [(build, name, targets, force) for name in names]
+    if n_jobs == 1:
+        return dict(zip(names, map(_run_dataset, args)))
+    with ProcessPoolExecutor(n_jobs) as executor:
+        return dict(zip(names, executor.map(_run_dataset, args)))
+
+
+def _run_dataset(args):
+    build, name, targets, force = args
+    return build(name).run(targets, force)
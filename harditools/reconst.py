@@ -1,37 +1,152 @@
+import os
+import tempfile
 import numpy as np
+import nibabel as nib
+from collections import OrderedDict
+from functools import lru_cache
+from multiprocessing import Pool, get_context
 from dipy.reconst import dti, csdeconv
 from dipy.reconst.shm import sph_harm_ind_list
 from dipy.data import get_sphere
-from dipy.direction import sh_to_sf_matrix, peak_directions, gfa
-from dipy.core.ndindex import ndindex
-from .utils import order_to_ncoef, order_from_ncoef
+from dipy.core.sphere import Sphere
+from dipy.direction import sh_to_sf_matrix, gfa
+from .cache import cached_call
+from .instrument import instrumented
+from .sphere import sphere_hash, sphere_index
+from .utils import (order_to_ncoef, order_from_ncoef, create_data, gzip_file,
+                    gunzip_file, decompressed, MaskedVolume, NII_CACHE_DIR)
 
 
 class Peaks(object):
+    __slots__ = ('peak_dirs', 'peak_values', 'indices', 'sphere', 'qa', 'gfa',
+                 'mask', '_cache')
+    _fields = ('peak_dirs', 'peak_values', 'indices', 'qa', 'gfa')
+    _compact_dtypes = ('float32', 'float32', 'int16', 'float32', 'float32')
+
     def __init__(self, peak_dirs, peak_values, indices,
-                 sphere, qa, gfa):
+                 sphere, qa, gfa, mask=None):
         self.peak_dirs = peak_dirs
         self.peak_values = peak_values
         self.indices = indices
         self.sphere = sphere
         self.qa = qa
         self.gfa = gfa
+        self.mask = mask
+        self._cache = {}
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__
+                if name != '_cache'}
+
+    def __setstate__(self, state):
+        # Also accepts the __dict__ of Peaks pickled before __slots__
+        if isinstance(state, tuple):
+            state = state[1]
+        self.mask = None
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._cache = {}
+
+    def compact(self, mask=None):
+        # Converts the directions, values, qa and gfa to float32 and the
+        # indices to int16. If a mask is given (or set), only the voxels in
+        # it are stored and the fields become lazy MaskedVolume views.
+        if mask is None:
+            mask = self.mask
+
+        for field, dtype in zip(self._fields, self._compact_dtypes):
+            data = getattr(self, field)
+            if isinstance(data, MaskedVolume):
+                data = data.data
+            elif mask is not None and data.shape[:mask.ndim] == mask.shape:
+                data = data[mask]
+            data = data.astype(dtype)
+            if mask is not None:
+                data = MaskedVolume(data, mask)
+            setattr(self, field, data)
+
+        self.mask = mask
+        self._cache = {}
+        return self
+
+    def save(self, path, mask=None):
+        # Writes each field as an uncompressed .npy file in the directory
+        # `path`, so they can be memory mapped by Peaks.load. Volumetric
+        # fields are reduced to the voxels of `mask`, which is saved too.
+        if mask is None:
+            mask = self.mask
+
+        os.makedirs(path, exist_ok=True)
+        for field in self._fields:
+            data = getattr(self, field)
+            if mask is not None and data.shape[:mask.ndim] == mask.shape:
+                data = data[mask]
+            np.save(os.path.join(path, field + '.npy'), data)
+
+        if mask is not None:
+            np.save(os.path.join(path, 'mask.npy'), mask)
+        np.save(os.path.join(path, 'vertices.npy'), self.sphere.vertices)
+        if self.sphere.faces is not None:
+            np.save(os.path.join(path, 'faces.npy'), self.sphere.faces)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        # Loads peaks written by Peaks.save. With the default mmap_mode the
+        # fields are read-only memory maps served from the page cache. The
+        # fields hold the masked voxels only, see `mask` and unflatten_all.
+        fields = [np.load(os.path.join(path, field + '.npy'),
+                          mmap_mode=mmap_mode) for field in cls._fields]
+
+        vertices = np.load(os.path.join(path, 'vertices.npy'))
+        sphere = load_sphere()
+        if not np.array_equal(vertices, sphere.vertices):
+            facesfn = os.path.join(path, 'faces.npy')
+            faces = np.load(facesfn) if os.path.exists(facesfn) else None
+            sphere = Sphere(xyz=vertices, faces=faces)
+
+        maskfn = os.path.join(path, 'mask.npy')
+        mask = np.load(maskfn) if os.path.exists(maskfn) else None
+
+        peak_dirs, peak_values, indices, qa, gfa = fields
+        return cls(peak_dirs, peak_values, indices, sphere, qa, gfa, mask)
 
     def num_peaks(self):
-        return (self.peak_values != 0).sum(axis=-1)
+        if 'num_peaks' not in self._cache:
+            values = self.peak_values
+            if isinstance(values, MaskedVolume):
+                self._cache['num_peaks'] = MaskedVolume(
+                    (values.data != 0).sum(axis=-1), values.mask)
+            else:
+                self._cache['num_peaks'] = (values != 0).sum(axis=-1)
+        return self._cache['num_peaks']
 
     def peakmask(self, thresh=1, comp='gt'):
         # Generates a spatial mask that returns true
         # if the odf has at least `numpeaks` peaks
 
-        if comp == 'gt':
-            return self.num_peaks() >= thresh
-        if comp == 'lt':
-            return self.num_peaks() <= thresh
-        if comp == 'eq':
-            return self.num_peaks() == thresh
+        key = ('peakmask', thresh, comp)
+        if key not in self._cache:
+            if comp == 'gt':
+                self._cache[key] = self.num_peaks() >= thresh
+            if comp == 'lt':
+                self._cache[key] = self.num_peaks() <= thresh
+            if comp == 'eq':
+                self._cache[key] = self.num_peaks() == thresh
+        return self._cache.get(key)
+
+    def unflatten_all(self, mask, lazy=False):
+        # With `lazy`, the fields become MaskedVolume views that are only
+        # expanded to the full volume when needed
+        self._cache = {}
+        if lazy:
+            self.mask = mask
+            for field in self._fields:
+                data = getattr(self, field)
+                if isinstance(data, MaskedVolume):
+                    data = data.data
+                setattr(self, field, MaskedVolume(data, mask))
+            return
 
-    def unflatten_all(self, mask):
         self.peak_dirs = self._unflatten(self.peak_dirs, mask)
         self.peak_values = self._unflatten(self.peak_values, mask)
         self.indices = self._unflatten(self.indices, mask)
@@ -40,6 +155,9 @@ class Peaks(object):
 
     def _unflatten(self, data, mask):
 
+        if isinstance(data, MaskedVolume):
+            return np.asarray(data)
+
         dtype = data.dtype
 
         if data.ndim == 1:
@@ -59,68 +177,314 @@ def tensor(data, gtab, mask):
     return tenmodel, tenfit
 
 
-def wm_mask_from_data(data, gtab, mask):
-    tenmodel, tenfit = tensor(data, gtab, mask)
-    FA = dti.fractional_anisotropy(tenfit.evals)
-    MD = dti.mean_diffusivity(tenfit.evals)
-    wm_mask = (np.logical_or(
-        FA >= 0.4, (np.logical_and(FA >= 0.15, MD >= 0.0011))))
+@instrumented(voxels='mask')
+def wm_mask_from_data(data, gtab, mask, chunk_size=10000, n_jobs=1,
+                      cache=None):
+    # `cache`: see cache.cached_call
+    def compute():
+        maps = dti_maps(data, gtab, mask, chunk_size=chunk_size,
+                        n_jobs=n_jobs)
+        FA, MD = maps.fa, maps.md
+        return (np.logical_or(
+            FA >= 0.4, (np.logical_and(FA >= 0.15, MD >= 0.0011))))
 
+    wm_mask = cached_call('wm_mask', compute, (data, gtab, mask), mask=mask,
+                          cache=cache)
     return wm_mask
 
 
-def csd_response(data, gtab, mask, sh_order=8):
-    response = csdeconv.recursive_response(gtab, data, mask=mask, sh_order=sh_order,
+class TensorMaps(object):
+    # Scalar and directional DTI maps of a dti_maps fit, zero outside mask
+    __slots__ = ('fa', 'md', 'rgb', 'pdd', 'mask')
+
+    def __init__(self, fa, md, rgb, pdd, mask):
+        self.fa = fa
+        self.md = md
+        self.rgb = rgb
+        self.pdd = pdd
+        self.mask = mask
+
+
+@instrumented(voxels='mask')
+def dti_maps(data, gtab, mask, chunk_size=10000, n_jobs=1,
+             dtype='float32', min_signal=dti.MIN_POSITIVE_SIGNAL):
+    # WLS tensor fit of the voxels in `mask` (same estimator as
+    # dti.TensorModel's default), solved for a chunk of voxels at a time
+    # through batched 7x7 normal equations. FA, MD, the principal direction
+    # and the FA-weighted RGB map are computed from each chunk straight
+    # away and nothing else is kept. n_jobs > 1 (None: all cores) fits the
+    # chunks in a process pool.
+    X = dti.design_matrix(gtab)
+    voxels = np.flatnonzero(mask)
+    ijk_chunks = [np.unravel_index(voxels[start:start + chunk_size],
+                                   mask.shape)
+                  for start in range(0, voxels.size, chunk_size)]
+
+    fa = np.zeros(mask.shape, dtype=dtype)
+    md = np.zeros(mask.shape, dtype=dtype)
+    pdd = np.zeros(mask.shape + (3,), dtype=dtype)
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(min(n_jobs, len(ijk_chunks)), 1)
+
+    args = ((X, data[ijk], min_signal) for ijk in ijk_chunks)
+    if n_jobs > 1:
+        with Pool(n_jobs) as pool:
+            results = pool.imap(_dti_chunk_worker, args)
+            for ijk, result in zip(ijk_chunks, results):
+                fa[ijk], md[ijk], pdd[ijk] = result
+    else:
+        for ijk, arg in zip(ijk_chunks, args):
+            fa[ijk], md[ijk], pdd[ijk] = _dti_chunk_worker(arg)
+
+    rgb = np.abs(pdd) * np.clip(fa, 0, 1)[..., None]
+    return TensorMaps(fa, md, rgb, pdd, mask)
+
+
+def _dti_chunk_worker(args):
+    return dti_chunk(*args)
+
+
+def dti_chunk(X, signal, min_signal=dti.MIN_POSITIVE_SIGNAL):
+    # FA, MD and principal direction of (n, ndwi) signals. The OLS fit sets
+    # the weights, then the WLS problems are solved through their normal
+    # equations, which equals dti.wls_fit_tensor's per-voxel pinv.
+    log_s = np.log(np.maximum(signal, min_signal))
+    beta = log_s @ np.linalg.pinv(X).T
+    w2 = np.exp(2 * (beta @ X.T))
+
+    XX = (X[:, :, None] * X[:, None, :]).reshape(X.shape[0], -1)
+    A = (w2 @ XX).reshape(-1, X.shape[1], X.shape[1])
+    b = (w2 * log_s) @ X
+    beta = np.linalg.solve(A, b[..., None])[..., 0]
+
+    # Lower triangular order: Dxx, Dxy, Dyy, Dxz, Dyz, Dzz
+    D = beta[:, [0, 1, 3, 1, 2, 4, 3, 4, 5]].reshape(-1, 3, 3)
+    evals, evecs = np.linalg.eigh(D)
+    evals = evals[:, ::-1].clip(min=1e-6 / -X.min())
+
+    all_zero = (evals == 0).all(axis=-1)
+    ev1, ev2, ev3 = evals.T
+    fa = np.sqrt(0.5 * ((ev1 - ev2)**2 + (ev2 - ev3)**2 + (ev3 - ev1)**2) /
+                 ((evals * evals).sum(-1) + all_zero))
+    md = evals.mean(axis=-1)
+    return fa, md, evecs[:, :, -1]
+
+
+@instrumented(voxels='mask')
+def csd_response(data, gtab, mask, sh_order=8, cache=None):
+    # `cache`: see cache.cached_call
+    def compute():
+        return csdeconv.recursive_response(gtab, data, mask=mask, sh_order=sh_order,
                                            peak_thr=0.01, init_fa=0.08,
                                            init_trace=0.0021, iter=8, convergence=0.001,
                                            parallel=True)
+
+    response = cached_call('response', compute, (data, gtab, mask, sh_order),
+                           mask=mask, cache=cache)
     return response
 
 
+@instrumented(voxels='mask')
 def csd(response, data, gtab, mask,
-        sh_order=8, reg_sphere=None, lambda_=1, tau=0.1):
+        sh_order=8, reg_sphere=None, lambda_=1, tau=0.1,
+        dtype='float64', chunk_size=1000):
 
     model = csdeconv.ConstrainedSphericalDeconvModel(gtab=gtab,
                                                      response=response,
                                                      reg_sphere=reg_sphere,
                                                      sh_order=sh_order,
-                                                     lambda_=1,
-                                                     tau=0.1)
-
-    fit = model.fit(data, mask)
+                                                     lambda_=lambda_,
+                                                     tau=tau)
 
-    inmaskfod = np.array(
-        [fit.shm_coeff for fit in fit.fit_array.flatten()[mask.flatten()]])
-    fod = np.zeros((mask.size, inmaskfod.shape[1]), dtype=inmaskfod.dtype)
-    fod[mask.flatten()] = inmaskfod
-    fod = fod.reshape(mask.shape + (order_to_ncoef(sh_order),))
+    fod = np.zeros(mask.shape + (order_to_ncoef(sh_order),), dtype=dtype)
+    fit_sh(model, data, mask, fod, chunk_size=chunk_size)
 
     return model, fod
 
 
-def sh2odf(sh, sphere=None):
+def fit_sh(model, data, mask, out, chunk_size=1000):
+    # Fits `model` voxel by voxel inside `mask` and writes the SH
+    # coefficients straight into `out` (shape mask.shape + (ncoef,)), so no
+    # array of per-voxel fit objects is ever built. `data` is read a block
+    # of voxels at a time and may be any array-like that supports fancy
+    # indexing, in any memory layout.
+    voxels = np.flatnonzero(mask)
+    coeff = np.empty((chunk_size, out.shape[-1]))
+
+    for start in range(0, voxels.size, chunk_size):
+        ijk = np.unravel_index(voxels[start:start + chunk_size], mask.shape)
+        signal = data[ijk]
+        n = signal.shape[0]
+
+        for i in range(n):
+            coeff[i] = model.fit(signal[i]).shm_coeff
+        out[ijk] = coeff[:n]
+
+    return out
+
+
+@instrumented(voxels='mask')
+def csd_streaming(img, gtab, mask, response, fn, slab=8,
+                  sh_order=8, reg_sphere=None, lambda_=1, tau=0.1,
+                  dtype='float32'):
+    # Fits CSD a slab of z-slices at a time, reading the DWI through the
+    # nibabel array proxy of `img` and writing each FOD slab straight into
+    # the output file `fn`, so memory use is bounded by the slab size.
+    # A .nii.gz `fn` is written uncompressed first and compressed at the
+    # end. A .nii.gz `img` would be inflated from the start for every slab,
+    # so it is inflated once (to the NII_CACHE_DIR copy when that is set,
+    # to a temporary file next to `fn` otherwise) and read from there.
+
+    model = csdeconv.ConstrainedSphericalDeconvModel(gtab=gtab,
+                                                     response=response,
+                                                     reg_sphere=reg_sphere,
+                                                     sh_order=sh_order,
+                                                     lambda_=lambda_,
+                                                     tau=tau)
+
+    tmpfn = None
+    src = img.get_filename()
+    if src is not None and src.endswith('.gz'):
+        if NII_CACHE_DIR is not None:
+            img = nib.load(decompressed(src))
+        else:
+            fd, tmpfn = tempfile.mkstemp(suffix='.nii',
+                                         dir=os.path.dirname(fn) or '.')
+            os.close(fd)
+
+    try:
+        if tmpfn is not None:
+            img = nib.load(gunzip_file(src, tmpfn))
+
+        niifn = fn[:-3] if fn.endswith('.gz') else fn
+        fod = create_data(niifn, mask.shape + (order_to_ncoef(sh_order),),
+                          dtype, img)
+
+        for z0 in range(0, mask.shape[2], slab):
+            z1 = min(z0 + slab, mask.shape[2])
+            slab_mask = mask[:, :, z0:z1]
+            if not slab_mask.any():
+                continue
+
+            data = img.dataobj[:, :, z0:z1]
+            fod_slab = np.zeros(slab_mask.shape + fod.shape[-1:],
+                                dtype=dtype)
+            fit_sh(model, data, slab_mask, fod_slab)
+            fod[:, :, z0:z1] = fod_slab
+            fod.flush()
+
+        del fod
+    finally:
+        if tmpfn is not None and os.path.exists(tmpfn):
+            os.remove(tmpfn)
+
+    if niifn != fn:
+        gzip_file(niifn, fn)
+
+    return model, nib.load(fn)
+
+
+# Directory where SH basis matrices are also stored as .npy, or None to
+# only keep them in memory
+BASIS_CACHE_DIR = os.environ.get('HARDITOOLS_BASIS_CACHE')
+BASIS_CACHE_SIZE = 32
+_basis_cache = OrderedDict()
+
+
+@lru_cache(maxsize=None)
+def load_sphere(name='symmetric724'):
+    return get_sphere(name)
+
+
+def sh_basis(sphere, sh_order, basis_type=None, smooth=0):
+    # Cached (read only) version of dipy's sh_to_sf_matrix(...,
+    # return_inv=False). Matrices are kept in a bounded LRU cache keyed by
+    # the sphere vertices and the basis parameters, and are persisted in
+    # BASIS_CACHE_DIR when it is set.
+    key = '{}_{}_{}_{}'.format(sphere_hash(sphere), sh_order,
+                               basis_type, smooth)
+
+    if key in _basis_cache:
+        _basis_cache.move_to_end(key)
+        return _basis_cache[key]
+
+    fn = None
+    if BASIS_CACHE_DIR is not None:
+        fn = os.path.join(BASIS_CACHE_DIR, 'sh_basis_{}.npy'.format(key))
+
+    if fn is not None and os.path.exists(fn):
+        B = np.load(fn)
+    else:
+        B = sh_to_sf_matrix(sphere, sh_order, basis_type=basis_type,
+                            return_inv=False, smooth=smooth)
+        if fn is not None:
+            # Written under a temporary name and moved into place, so that
+            # other processes never load a partly written file
+            os.makedirs(BASIS_CACHE_DIR, exist_ok=True)
+            tmpfn = '{}.{}.tmp'.format(fn, os.getpid())
+            try:
+                with open(tmpfn, 'wb') as f:
+                    np.save(f, B)
+                os.replace(tmpfn, fn)
+            finally:
+                if os.path.exists(tmpfn):
+                    os.remove(tmpfn)
+
+    B.setflags(write=False)
+    _basis_cache[key] = B
+    while len(_basis_cache) > BASIS_CACHE_SIZE:
+        _basis_cache.popitem(last=False)
+
+    return B
+
+
+@instrumented(voxels='sh')
+def sh2odf(sh, sphere=None, dtype=None):
 
     shape = sh.shape[:-1]
 
     if sphere == None:
-        sphere = get_sphere('symmetric724')
+        sphere = load_sphere()
 
     sh_order = order_from_ncoef(sh.shape[-1])
 
-    B = sh_to_sf_matrix(sphere, sh_order, return_inv=False)
+    B = sh_basis(sphere, sh_order)
+    if dtype is not None:
+        sh, B = sh.astype(dtype, copy=False), B.astype(dtype)
 
     odf = np.dot(sh, B)
 
     return odf
 
 
+def iter_sh2odf(sh, mask=None, sphere=None, dtype='float32', chunk_size=10000):
+    # Generator version of sh2odf that never holds more than `chunk_size`
+    # odfs. Yields (voxels, odf) pairs where `voxels` are flat indices into
+    # sh.shape[:-1] of the (masked) voxels in each chunk.
+    if sphere == None:
+        sphere = load_sphere()
+    if mask is None:
+        mask = np.ones(sh.shape[:-1], dtype='bool')
+
+    B = sh_basis(sphere, order_from_ncoef(sh.shape[-1])).astype(dtype)
+    flat_sh = sh.reshape(-1, sh.shape[-1])
+    voxels = np.flatnonzero(mask)
+
+    for start in range(0, voxels.size, chunk_size):
+        block = voxels[start:start + chunk_size]
+        yield block, np.dot(flat_sh[block].astype(dtype, copy=False), B)
+
+
+@instrumented(voxels=('mask', 'odf'))
 def calc_peaks(odf, mask=None, sphere=None, npeaks=5, peak_thresh=0.5, min_angle=25,
-               gfa_thr=0, normalize_peaks=False):
+               gfa_thr=0, normalize_peaks=False, chunk_size=1000, n_jobs=1):
 
     shape = odf.shape[:-1]
 
     if sphere == None:
-        sphere = get_sphere('symmetric724')
+        sphere = load_sphere()
     if mask is None:
         mask = np.ones(shape, dtype='bool')
 
@@ -132,31 +496,101 @@ def calc_peaks(odf, mask=None, sphere=None, npeaks=5, peak_thresh=0.5, min_angle
     peak_indices = np.zeros((shape + (npeaks,)), dtype='int')
     peak_indices.fill(-1)
 
+    # Flat views so that blocks of masked voxels can be written in place
+    flat_odf = odf.reshape(-1, odf.shape[-1])
+    flat_peaks = (qa_array.reshape(-1, npeaks),
+                  peak_dirs.reshape(-1, npeaks, 3),
+                  peak_values.reshape(-1, npeaks),
+                  peak_indices.reshape(-1, npeaks))
+
+    voxels = np.flatnonzero(mask)
+    skipped = voxels[gfa_array.ravel()[voxels] < gfa_thr]
+    voxels = voxels[gfa_array.ravel()[voxels] >= gfa_thr]
+
     global_max = -np.inf
-    for idx in ndindex(shape):
-        if not mask[idx]:
-            continue
+    if skipped.size:
+        global_max = max(global_max, flat_odf[skipped].max())
+
+    index = sphere_index(sphere)
+    neighbors = index.neighbors
+    similar = index.similar(min_angle)
+
+    blocks = []
+    for start in range(0, voxels.size, chunk_size):
+        block = voxels[start:start + chunk_size]
+        if block[-1] - block[0] + 1 == block.size:
+            block = slice(block[0], block[-1] + 1)
+        blocks.append(block)
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+
+    if n_jobs == 1 or len(blocks) < 2:
+        results = (_peaks_block(flat_odf[block], neighbors, similar, peak_thresh)
+                   for block in blocks)
+    else:
+        results = _parallel_peaks(flat_odf, blocks, neighbors, similar,
+                                  peak_thresh, n_jobs)
+
+    for block, result in zip(blocks, results):
+        global_max = max(global_max, _store_peaks(
+            flat_peaks, block, sphere.vertices, normalize_peaks, *result))
 
-        if gfa_array[idx] < gfa_thr:
-            global_max = max(global_max, odf[idx].max())
-            continue
+    qa_array /= global_max
 
-        direction, pk, ind = peak_directions(odf[idx], sphere,
-                                             relative_peak_threshold=peak_thresh,
-                                             min_separation_angle=min_angle)
+    peaks = Peaks(peak_dirs, peak_values, peak_indices,
+                  sphere, qa_array, gfa_array)
 
-        if pk.shape[0] != 0:
-            global_max = max(global_max, pk[0])
+    return peaks
 
-            n = min(npeaks, pk.shape[0])
-            qa_array[idx][:n] = pk[:n] - odf[idx].min()
-            peak_dirs[idx][:n] = direction[:n]
-            peak_indices[idx][:n] = ind[:n]
-            peak_values[idx][:n] = pk[:n]
 
-            if normalize_peaks:
-                peak_values[idx][:n] /= pk[0]
-                peak_dirs[idx] *= peak_values[idx][:, None]
+@instrumented(voxels=('mask', 'sh'))
+def sh_to_peaks(sh, mask=None, sphere=None, npeaks=5, peak_thresh=0.5, min_angle=25,
+                gfa_thr=0, normalize_peaks=False, chunk_size=1000,
+                dtype='float64'):
+    # Fused sh2odf + calc_peaks. Each chunk of voxels is projected onto the
+    # sphere and reduced to its peaks and GFA straight away, so the full odf
+    # array never exists. GFA is only computed inside `mask`.
+
+    shape = sh.shape[:-1]
+
+    if sphere == None:
+        sphere = load_sphere()
+    if mask is None:
+        mask = np.ones(shape, dtype='bool')
+
+    gfa_array = np.zeros(shape)
+    qa_array = np.zeros((shape + (npeaks,)))
+    peak_dirs = np.zeros((shape + (npeaks, 3)))
+    peak_values = np.zeros((shape + (npeaks,)))
+    peak_indices = np.zeros((shape + (npeaks,)), dtype='int')
+    peak_indices.fill(-1)
+
+    flat_gfa = gfa_array.reshape(-1)
+    flat_peaks = (qa_array.reshape(-1, npeaks),
+                  peak_dirs.reshape(-1, npeaks, 3),
+                  peak_values.reshape(-1, npeaks),
+                  peak_indices.reshape(-1, npeaks))
+
+    index = sphere_index(sphere)
+    neighbors = index.neighbors
+    similar = index.similar(min_angle)
+
+    global_max = -np.inf
+    for block, odf in iter_sh2odf(sh, mask, sphere, dtype, chunk_size):
+        block_gfa = gfa(odf)
+        flat_gfa[block] = block_gfa
+
+        skipped = block_gfa < gfa_thr
+        if skipped.any():
+            global_max = max(global_max, odf[skipped].max())
+            block, odf = block[~skipped], odf[~skipped]
+        if not block.size:
+            continue
+
+        result = _peaks_block(odf, neighbors, similar, peak_thresh)
+        global_max = max(global_max, _store_peaks(
+            flat_peaks, block, sphere.vertices, normalize_peaks, *result))
 
     qa_array /= global_max
 
@@ -166,8 +600,168 @@ def calc_peaks(odf, mask=None, sphere=None, npeaks=5, peak_thresh=0.5, min_angle
     return peaks
 
 
-def calc_gfa(odf):
-    return gfa(odf.reshape(-1, odf.shape[-1])).reshape(odf.shape[:-1])
+def _store_peaks(flat_peaks, block, vertices, normalize_peaks,
+                 pk, ind, odf_min):
+    # Writes the output of _peaks_block for `block` into the flat peak
+    # arrays and returns the largest peak (-inf if there were none)
+    flat_qa, flat_dirs, flat_values, flat_indices = flat_peaks
+    npeaks = flat_values.shape[-1]
+
+    found = ind[:, 0] >= 0
+    if not found.any():
+        return -np.inf
+
+    n = min(npeaks, pk.shape[1])
+    pk, ind = pk[:, :n], ind[:, :n]
+    valid = ind >= 0
+
+    flat_qa[block, :n] = np.where(valid, pk - odf_min[:, None], 0)
+    flat_dirs[block, :n] = np.where(valid[..., None], vertices[ind], 0)
+    flat_indices[block, :n] = ind
+    flat_values[block, :n] = pk
+
+    if normalize_peaks:
+        first = np.where(found, pk[:, 0], 1)
+        flat_values[block, :n] /= first[:, None]
+        flat_dirs[block] *= flat_values[block][..., None]
+
+    return pk[found, 0].max()
+
+
+def _parallel_peaks(flat_odf, blocks, neighbors, similar, peak_thresh, n_jobs):
+    # Yields the results of _peaks_block for `blocks` in order, computed by
+    # a pool of workers. The odfs are put in _worker before the workers are
+    # forked, so they read the parent's array (copy on write) and it is
+    # never copied or sent between processes.
+    _worker['odf'] = flat_odf
+    _worker['args'] = (neighbors, similar, peak_thresh)
+    try:
+        with get_context('fork').Pool(n_jobs) as pool:
+            for result in pool.imap(_peaks_worker, blocks):
+                yield result
+    finally:
+        _worker.clear()
+
+
+_worker = {}
+
+
+def _peaks_worker(block):
+    return _peaks_block(_worker['odf'][block], *_worker['args'])
+
+
+def _local_maxima(odf, rows, cols, neighbors):
+    # Tests the vertices `cols` of rows `rows` in `odf` against their
+    # neighbours. A vertex is a maximum if it is greater than at least one
+    # neighbour and greater than or equal to all of them. Neighbours are
+    # compared one column of the table at a time, dropping the vertices
+    # that already lost, so most candidates only cost a couple of gathers.
+    flat = odf.ravel()
+    base = rows * odf.shape[1]
+    values = flat.take(base + cols)
+    greater = np.zeros(cols.size, dtype='bool')
+    for column in neighbors.T:
+        nbr = flat.take(base + column.take(cols))
+        greater |= values > nbr
+        ok = values >= nbr
+        if not ok.all():
+            base, cols, values, greater = (base[ok], cols[ok], values[ok],
+                                           greater[ok])
+    rows = base // odf.shape[1]
+    return rows[greater], cols[greater], values[greater]
+
+
+def _peaks_block(odf, neighbors, similar, peak_thresh):
+    # Batched equivalent of dipy's peak_directions over a (n, nverts) block.
+    # Returns (n, k) peak values and vertex indices sorted in descending
+    # order, padded with 0 and -1 respectively, and the minimum of each odf.
+    n = odf.shape[0]
+    odf_max = odf.max(axis=-1)
+    if np.isnan(odf_max).any():
+        raise ValueError('odf can not have nans')
+    raw_min = odf.min(axis=-1)
+    odf_min = np.maximum(raw_min, 0)
+
+    # The largest local maximum is normally the global maximum, so only
+    # vertices passing the relative threshold against it are candidates.
+    # Rows where that does not hold (plateaus) are redone with every vertex.
+    # The threshold is loosened by a few ulps so that the candidates are
+    # a superset of the peaks kept by the exact test further down.
+    if peak_thresh <= 1:
+        thresh = odf_min + (odf_max - odf_min) * peak_thresh
+        thresh -= 4 * np.finfo(odf.dtype).eps * (np.abs(odf_max) + odf_min)
+        cand = odf >= thresh[:, None]
+    else:
+        cand = np.ones(odf.shape, dtype='bool')
+    # flatnonzero and a division are cheaper than a 2D nonzero
+    idx = np.flatnonzero(cand)
+    rows = idx // odf.shape[1]
+    rows, cols, values = _local_maxima(odf, rows, idx - rows * odf.shape[1],
+                                       neighbors)
+
+    top = np.full(n, -np.inf)
+    np.maximum.at(top, rows, values)
+    redo = np.flatnonzero((top != odf_max) & (odf_max >= 0))
+    if redo.size:
+        keep = ~np.isin(rows, redo)
+        rrows, rcols = np.nonzero(np.ones((redo.size, odf.shape[1]), 'bool'))
+        rrows = redo[rrows]
+        rrows, rcols, rvalues = _local_maxima(odf, rrows, rcols, neighbors)
+        rows = np.concatenate((rows[keep], rrows))
+        cols = np.concatenate((cols[keep], rcols))
+        values = np.concatenate((values[keep], rvalues))
+
+    # Descending by value, ties kept in ascending vertex order as in dipy
+    order = np.lexsort((cols, -values, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+
+    counts = np.bincount(rows, minlength=n)
+    k = max(counts.max(), 1) if n else 1
+    pos = np.arange(rows.size) - (np.cumsum(counts) - counts)[rows]
+
+    ind = np.full((n, k), -1, dtype='int')
+    peak_values = np.full((n, k), -np.inf)
+    ind[rows, pos] = cols
+    peak_values[rows, pos] = values
+
+    # Remove small peaks relative to the largest one
+    values_norm = peak_values - odf_min[:, None]
+    keep = (ind >= 0) & (values_norm >= values_norm[:, :1] * peak_thresh)
+    keep[counts == 1, 0] = True
+    keep[peak_values[:, 0] < 0] = False
+
+    k = max(keep.sum(axis=-1).max(), 1) if n else 1
+    keep, ind, peak_values = keep[:, :k], ind[:, :k], peak_values[:, :k]
+
+    # Remove peaks too close to a larger one that was kept
+    for j in range(1, k):
+        close = similar[ind[:, j:j + 1], ind[:, :j]] & keep[:, :j]
+        keep[:, j] &= ~close.any(axis=-1)
+
+    # Shift the surviving peaks to the front of each row
+    rows, cols = np.nonzero(keep)
+    counts = np.bincount(rows, minlength=n)
+    k = max(counts.max(), 1) if n else 1
+    pos = np.arange(rows.size) - (np.cumsum(counts) - counts)[rows]
+
+    out_ind = np.full((n, k), -1, dtype='int')
+    out_values = np.zeros((n, k))
+    out_ind[rows, pos] = ind[rows, cols]
+    out_values[rows, pos] = peak_values[rows, cols]
+
+    return out_values, out_ind, raw_min
+
+
+@instrumented(voxels='odf')
+def calc_gfa(odf, chunk_size=1000):
+    # dipy's gfa makes several full size temporaries, so it is run over
+    # blocks of voxels that stay in cache
+    flat = odf.reshape(-1, odf.shape[-1])
+    gfa_array = np.empty(flat.shape[0])
+    for start in range(0, flat.shape[0], chunk_size):
+        gfa_array[start:start + chunk_size] = gfa(
+            flat[start:start + chunk_size])
+    return gfa_array.reshape(odf.shape[:-1])
 
 
 def order_to_jrange(order):
@@ -176,12 +770,27 @@ def order_to_jrange(order):
     return j0, jf
 
 
-def sh_power(sh):
+@lru_cache(maxsize=None)
+def band_starts(order):
+    # Index of the first coefficient of each even band up to `order`
+    return np.array([order_to_jrange(band)[0]
+                     for band in range(0, order + 1, 2)])
+
+
+@instrumented(voxels='sh')
+def sh_power(sh, dtype='float64', chunk_size=None):
+    # Power in each even SH band for an array of shape (..., ncoef), e.g.
+    # a masked (N, ncoef) array or a full FOD volume. With `chunk_size`
+    # the input is processed that many entries of its first axis at a
+    # time, which bounds the size of the temporaries.
     order = order_from_ncoef(sh.shape[-1])
-    bands = np.arange(0, order + 1, 2)
-    sh_power = np.zeros((sh.shape[:3] + (bands.size,)))
+    starts = band_starts(order)
+
+    if chunk_size is None:
+        return np.add.reduceat(np.square(sh, dtype=dtype), starts, axis=-1)
 
-    for i, band in enumerate(bands):
-        j0, jf = order_to_jrange(band)
-        sh_power[..., i] = np.sum((sh[..., j0:jf+1])**2, axis=-1)
-    return sh_power
+    power = np.empty(sh.shape[:-1] + (starts.size,), dtype=dtype)
+    for i in range(0, sh.shape[0], chunk_size):
+        power[i:i + chunk_size] = np.add.reduceat(
+            np.square(sh[i:i + chunk_size], dtype=dtype), starts, axis=-1)
+    return power
@@ -0,0 +1,160 @@
+import os
+import numpy as np
+from multiprocessing import Pool
+from .utils import load_data
+
+
+def bin_indices(data, bins=256):
+    # Integer bin of every value, with `bins` equal-width bins over the data
+    # range (the binning np.histogram2d uses for an integer `bins`). As in
+    # np.histogram, the truncated index is corrected against the linspace
+    # edges, which rounding can put on either side of a value.
+    data = np.asarray(data, dtype='float64')
+    low, high = data.min(), data.max()
+    if high == low:
+        low, high = low - 0.5, high + 0.5
+    edges = np.linspace(low, high, bins + 1)
+    idx = ((data - low) * (bins / (high - low))).astype('intp')
+    np.minimum(idx, bins - 1, out=idx)
+    idx[data < edges[idx]] -= 1
+    idx[(data >= edges[idx + 1]) & (idx != bins - 1)] += 1
+    return idx
+
+
+def entropy(p):
+    p = p[p > 0]
+    return -np.sum(p * np.log(p))
+
+
+class RegistrationMetrics(object):
+    # Similarity of moving volumes to a fixed reference. The reference is
+    # masked, binned and normalised once and reused for every volume.
+    def __init__(self, ref, bins=256, mask=None):
+        self.bins = bins
+        self.mask = mask
+        ref = self._masked(ref)
+        self.ref_idx = bin_indices(ref, bins)
+        self.ref_offsets = self.ref_idx * bins
+
+        # Pearson correlation
+        centered = ref - ref.mean()
+        self.ref_centered = centered / np.sqrt(np.dot(centered, centered))
+
+        # Correlation ratio: number of voxels in each reference bin
+        self.ref_counts = np.bincount(self.ref_idx, minlength=bins)
+
+    def _masked(self, vol):
+        vol = np.asarray(vol, dtype='float64')
+        if self.mask is not None:
+            return vol[self.mask]
+        return vol.ravel()
+
+    def joint_histogram(self, vol):
+        idx = self.ref_offsets + bin_indices(self._masked(vol), self.bins)
+        hgram = np.bincount(idx, minlength=self.bins**2)
+        return hgram.reshape(self.bins, self.bins)
+
+    def mi(self, vol):
+        # Mutual information of the joint histogram
+        return self._mi(self.joint_histogram(vol))
+
+    def nmi(self, vol):
+        # Normalised mutual information, (H(ref) + H(vol)) / H(ref, vol)
+        return self._nmi(self.joint_histogram(vol))
+
+    def corr(self, vol):
+        # Pearson correlation coefficient
+        vol = self._masked(vol)
+        centered = vol - vol.mean()
+        return np.dot(self.ref_centered, centered) / \
+            np.sqrt(np.dot(centered, centered))
+
+    def corr_ratio(self, vol):
+        # Correlation ratio of vol given the reference bins: the fraction of
+        # the variance of vol explained by the reference intensity
+        vol = self._masked(vol)
+        total = vol.var() * vol.size
+        if total == 0:
+            return 0.0
+        sums = np.bincount(self.ref_idx, weights=vol, minlength=self.bins)
+        nz = self.ref_counts > 0
+        between = np.sum(sums[nz]**2 / self.ref_counts[nz]) - \
+            vol.sum()**2 / vol.size
+        return between / total
+
+    def score(self, vol, metrics=('mi',)):
+        # Several metrics of one volume, sharing the joint histogram
+        hgram = None
+        scores = []
+        for metric in metrics:
+            if metric in ('mi', 'nmi'):
+                if hgram is None:
+                    hgram = self.joint_histogram(vol)
+                scores.append(self._mi(hgram) if metric == 'mi'
+                              else self._nmi(hgram))
+            elif metric == 'corr':
+                scores.append(self.corr(vol))
+            elif metric == 'corr_ratio':
+                scores.append(self.corr_ratio(vol))
+            else:
+                raise ValueError('Unknown metric: {}'.format(metric))
+        return scores
+
+    @staticmethod
+    def _mi(hgram):
+        pxy = hgram / hgram.sum()
+        px = pxy.sum(axis=1)
+        py = pxy.sum(axis=0)
+        nzs = pxy > 0
+        return np.sum(pxy[nzs] * np.log(pxy[nzs] /
+                                        np.outer(px, py)[nzs]))
+
+    @staticmethod
+    def _nmi(hgram):
+        pxy = hgram / hgram.sum()
+        return (entropy(pxy.sum(axis=1)) + entropy(pxy.sum(axis=0))) / \
+            entropy(pxy.ravel())
+
+
+def mutual_information(im1, im2, bins=256, mask=None):
+    return RegistrationMetrics(im1, bins, mask).mi(im2)
+
+
+def score_volumes(ref, volumes, metrics=('mi',), bins=256, mask=None,
+                  n_jobs=1):
+    # Scores every volume (arrays or filenames, which are loaded by the
+    # workers) against `ref` (an array or a RegistrationMetrics). Returns a
+    # dict of metric -> array of scores in the order of `volumes`.
+    if not isinstance(ref, RegistrationMetrics):
+        ref = RegistrationMetrics(ref, bins, mask)
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, len(volumes))
+
+    args = [(vol, metrics) for vol in volumes]
+    if n_jobs > 1:
+        # The reference goes to each worker once instead of with every task
+        with Pool(n_jobs, initializer=_init_worker, initargs=(ref,)) as pool:
+            scores = pool.map(_score_worker, args)
+    else:
+        _init_worker(ref)
+        scores = [_score_worker(arg) for arg in args]
+        _worker.clear()
+
+    scores = np.array(scores).reshape(len(volumes), len(metrics))
+    return {metric: scores[:, i] for i, metric in enumerate(metrics)}
+
+
+_worker = {}
+
+
+def _init_worker(ref):
+    _worker['ref'] = ref
+
+
+def _score_worker(args):
+    vol, metrics = args
+    if isinstance(vol, str):
+        _, vol = load_data(vol, cache=False)
+    return _worker['ref'].score(vol, metrics)
@@ -0,0 +1,113 @@
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from scipy.spatial import cKDTree
+from .angles import nearest_neighbor_spacing
+
+# Number of SphereIndex objects kept by sphere_index
+SPHERE_INDEX_CACHE_SIZE = 8
+_index_cache = OrderedDict()
+
+
+def sphere_hash(sphere):
+    return hashlib.sha1(
+        np.ascontiguousarray(sphere.vertices, dtype='float64')).hexdigest()
+
+
+def sphere_index(sphere):
+    # Cached SphereIndex of `sphere`, built once per set of vertices
+    key = sphere_hash(sphere)
+    if key in _index_cache:
+        _index_cache.move_to_end(key)
+        return _index_cache[key]
+
+    index = SphereIndex(sphere)
+    _index_cache[key] = index
+    while len(_index_cache) > SPHERE_INDEX_CACHE_SIZE:
+        _index_cache.popitem(last=False)
+    return index
+
+
+class SphereIndex(object):
+    # Precomputed lookup structures of a sphere: the edge array, a padded
+    # neighbour table for local maxima, antipodal similarity tables for
+    # peak pruning, and a KD-tree over the vertices and their antipodes to
+    # map arbitrary directions to vertices in O(log n). Arrays are read only
+    # since the object is shared through sphere_index.
+    def __init__(self, sphere):
+        self.sphere = sphere
+        self.vertices = np.array(sphere.vertices, dtype='float64')
+        self.edges = np.array(sphere.edges)
+        self.neighbors = self._neighbors()
+        self.tree = cKDTree(np.vstack((self.vertices, -self.vertices)))
+        self._direct_tree = None
+        self._similar = {}
+        for a in [self.vertices, self.edges, self.neighbors]:
+            a.setflags(write=False)
+
+    def __len__(self):
+        return self.vertices.shape[0]
+
+    def _neighbors(self):
+        # (nvertices, max_degree) table of neighbouring vertices built from
+        # the sphere edges. Short rows are padded with the vertex itself,
+        # which never changes the result of a neighbour maximum.
+        nverts = len(self)
+        edges = np.vstack((self.edges, self.edges[:, ::-1]))
+        edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+
+        degree = np.bincount(edges[:, 0], minlength=nverts)
+        offsets = np.cumsum(degree) - degree
+        column = np.arange(edges.shape[0]) - offsets[edges[:, 0]]
+
+        neighbors = np.repeat(np.arange(nverts)[:, None],
+                              max(degree.max(), 1), axis=1)
+        neighbors[edges[:, 0], column] = edges[:, 1]
+        return neighbors
+
+    def similar(self, min_angle):
+        # Boolean table of vertex pairs closer than `min_angle` (antipodally
+        # symmetric), matching dipy's remove_similar_vertices test
+        if min_angle not in self._similar:
+            v = self.vertices
+            cos = (v[:, None, 0] * v[None, :, 0] +
+                   v[:, None, 1] * v[None, :, 1] +
+                   v[:, None, 2] * v[None, :, 2])
+            similar = np.abs(cos) > np.cos(np.pi / 180 * min_angle)
+            similar.setflags(write=False)
+            self._similar[min_angle] = similar
+        return self._similar[min_angle]
+
+    def nearest(self, dirs, antipodal=True):
+        # Nearest vertex of each direction in `dirs` (..., 3) and the angle
+        # to it in degrees. With `antipodal`, -v counts as v. Zero vectors
+        # (missing peaks) give index -1 and angle nan.
+        dirs = np.asarray(dirs, dtype='float64')
+        shape = dirs.shape[:-1]
+        dirs = dirs.reshape(-1, 3)
+        norms = np.linalg.norm(dirs, axis=1)
+        valid = norms > 0
+
+        indices = np.full(dirs.shape[0], -1, dtype='intp')
+        angles = np.full(dirs.shape[0], np.nan)
+        if valid.any():
+            tree = self.tree if antipodal else self._tree()
+            chord, idx = tree.query(dirs[valid] / norms[valid, None])
+            indices[valid] = idx % len(self)
+            angles[valid] = np.degrees(2 * np.arcsin(np.clip(chord / 2, 0, 1)))
+        return indices.reshape(shape), angles.reshape(shape)
+
+    def quantize(self, dirs, antipodal=True):
+        # Directions snapped to their nearest vertex (zero vectors stay 0)
+        indices, _ = self.nearest(dirs, antipodal)
+        return np.where(indices[..., None] >= 0, self.vertices[indices], 0)
+
+    def spacing(self, tol=1e-3):
+        # Antipodally symmetric angle from each vertex to its nearest other
+        # vertex, see angles.nearest_neighbor_spacing
+        return nearest_neighbor_spacing(self.vertices, True, tol, self.tree)
+
+    def _tree(self):
+        if self._direct_tree is None:
+            self._direct_tree = cKDTree(self.vertices)
+        return self._direct_tree
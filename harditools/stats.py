@@ -0,0 +1,214 @@
+import numpy as np
+
+
+class Moments(object):
+    # Running count, mean, variance (Welford, combined per chunk with Chan's
+    # update) and range. Accumulators filled separately, e.g. by different
+    # workers, can be merged.
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype='float64').ravel()
+        if values.size == 0:
+            return self
+        other = Moments()
+        other.n = values.size
+        other.mean = values.mean()
+        other.m2 = ((values - other.mean)**2).sum()
+        other.min = values.min()
+        other.max = values.max()
+        return self.merge(other)
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta**2 * self.n * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def var(self):
+        # nan with no values, as np.var
+        if self.n == 0:
+            return np.nan
+        return self.m2 / self.n
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+class QuantileSketch(object):
+    # Mergeable quantile sketch with relative accuracy `alpha` (DDSketch):
+    # values are counted in logarithmically sized buckets, so any quantile
+    # is returned within a relative error of alpha whatever the range.
+    def __init__(self, alpha=0.01, min_value=1e-9):
+        self.alpha = alpha
+        self.min_value = min_value
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.n = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype='float64').ravel()
+        small = np.abs(values) < self.min_value
+        self.zeros += int(small.sum())
+        self._add(self.positive, values[~small & (values > 0)])
+        self._add(self.negative, -values[~small & (values < 0)])
+        self.n += values.size
+        return self
+
+    def _add(self, store, values):
+        keys = np.ceil(np.log(values) / np.log(self.gamma)).astype('int64')
+        for key, count in zip(*np.unique(keys, return_counts=True)):
+            store[key] = store.get(key, 0) + int(count)
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('sketches must have the same accuracy')
+        for store, other_store in [(self.positive, other.positive),
+                                   (self.negative, other.negative)]:
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zeros += other.zeros
+        self.n += other.n
+        return self
+
+    def quantile(self, q):
+        # q in [0, 1], scalar or array
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan)
+
+        values, counts = self._buckets()
+        rank = np.asarray(q) * (self.n - 1)
+        idx = np.searchsorted(np.cumsum(counts), rank, side='right')
+        return values[idx]
+
+    def extent(self, lo, hi):
+        # Smallest and largest values in [lo, hi] (nan if there are none),
+        # to the accuracy of the sketch
+        values, counts = self._buckets()
+        inside = values[(counts > 0) & (values >= lo) & (values <= hi)]
+        if inside.size == 0:
+            return np.nan, np.nan
+        return inside[0], inside[-1]
+
+    def _buckets(self):
+        # Bucket values in increasing order and their counts
+        neg = np.array(sorted(self.negative, reverse=True), dtype='int64')
+        pos = np.array(sorted(self.positive), dtype='int64')
+        values = np.concatenate((-self._value(neg), [0], self._value(pos)))
+        counts = np.concatenate(([self.negative[k] for k in neg],
+                                 [self.zeros],
+                                 [self.positive[k] for k in pos]))
+        return values, counts
+
+    def _value(self, keys):
+        return 2 * self.gamma**keys / (self.gamma + 1)
+
+
+class Histogram(object):
+    # Fixed-bin histogram that is filled chunk by chunk. Values outside
+    # `bins` are counted as under/overflow, non-finite values are counted
+    # and otherwise ignored. Moments and quantiles are tracked over all
+    # finite values, including those outside `bins`. Histograms with the
+    # same bins can be merged.
+    def __init__(self, bins, alpha=0.01):
+        self.bins = np.asarray(bins, dtype='float64')
+        self.counts = np.zeros(self.bins.size - 1, dtype='int64')
+        self.underflow = 0
+        self.overflow = 0
+        self.nonfinite = 0
+        self.moments = Moments()
+        self.sketch = QuantileSketch(alpha)
+
+    def add(self, values):
+        values = np.asarray(values, dtype='float64').ravel()
+        finite = np.isfinite(values)
+        self.nonfinite += values.size - int(finite.sum())
+        values = values[finite]
+
+        self.moments.add(values)
+        self.sketch.add(values)
+
+        # Same convention as np.histogram: the last bin is closed
+        idx = np.searchsorted(self.bins, values, side='right') - 1
+        idx[values == self.bins[-1]] = self.counts.size - 1
+        self.underflow += int((idx < 0).sum())
+        self.overflow += int((idx >= self.counts.size).sum())
+        idx = idx[(idx >= 0) & (idx < self.counts.size)]
+        self.counts += np.bincount(idx, minlength=self.counts.size)
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError('histograms must have the same bins')
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.nonfinite += other.nonfinite
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def centers(self):
+        return (self.bins[:-1] + self.bins[1:]) / 2
+
+    @property
+    def n(self):
+        return self.moments.n
+
+    @property
+    def mean(self):
+        if self.n == 0:
+            return np.nan
+        return self.moments.mean
+
+    @property
+    def std(self):
+        return self.moments.std
+
+    @property
+    def mode(self):
+        # Center of the fullest bin
+        return self.centers[np.argmax(self.counts)]
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+
+def bin_edges(lo, hi, nbins):
+    # `nbins` equal bins spanning [lo, hi], as np.histogram picks them from
+    # the range of the data (nothing finite: [0, 1])
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        lo, hi = 0., 1.
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    return np.linspace(lo, hi, nbins + 1)
+
+
+def merge(accumulators):
+    # Merges a sequence of accumulators (or lists of them, e.g. one per SH
+    # band) into the first one
+    accumulators = list(accumulators)
+    first = accumulators[0]
+    for other in accumulators[1:]:
+        if isinstance(first, list):
+            for a, b in zip(first, other):
+                a.merge(b)
+        else:
+            first.merge(other)
+    return first
@@ -0,0 +1,137 @@
+import os
+import json
+import shutil
+import itertools
+import subprocess
+from multiprocessing import Pool
+from .utils import load_data
+from .registration_metrics import RegistrationMetrics
+
+
+def grid(**params):
+    # Every combination of the given parameter values, e.g.
+    # grid(cost=['corratio', 'mutualinfo'], dof=[3, 6, 9, 12])
+    names = list(params)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[params[n] for n in names])]
+
+
+def make_jobs(inputs, configs, output_fmt, names=None):
+    # One job per (config, input). `output_fmt` is formatted with the
+    # config values and `name`: names[i] for input i when given, the input
+    # filename without extension otherwise, e.g.
+    # 'dof{dof}_{weighting}/dof{dof}_{weighting}_{name}.nii.gz'
+    if names is None:
+        names = [os.path.basename(fn).split('.')[0] for fn in inputs]
+    if len(names) != len(inputs):
+        raise ValueError('Got {} names for {} inputs'.format(len(names),
+                                                            len(inputs)))
+    jobs = []
+    for config in configs:
+        for fn, name in zip(inputs, names):
+            jobs.append({'input': fn,
+                         'output': output_fmt.format(name=name, **config),
+                         'config': config})
+    return jobs
+
+
+def flirt(input, output, reference, cost='corratio', dof=12, interp='sinc',
+          weight=None, weighting='nw'):
+    # FSL flirt, with the translation-only schedule for dof=3. weighting='w'
+    # weights the cost by the reference itself.
+    if weighting == 'w':
+        weight = reference
+    cmd = ['flirt', '-cost', cost, '-interp', interp]
+    if dof == 3:
+        cmd += ['-schedule', os.path.join(os.environ['FSLDIR'], 'etc',
+                                          'flirtsch', 'sch3Dtrans_3dof')]
+    else:
+        cmd += ['-dof', str(dof)]
+    if weight is not None:
+        cmd += ['-refweight', weight]
+    cmd += ['-in', input, '-ref', reference, '-out', output]
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+
+
+def copy(input, output, reference, **config):
+    # Identity "registration", a stand-in for flirt that needs no FSL
+    shutil.copyfile(input, output)
+
+
+def load_manifest(fn):
+    # Completed jobs of a sweep, keyed by output filename
+    records = {}
+    if os.path.exists(fn):
+        with open(fn) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    records[record['output']] = record
+    return records
+
+
+def run_sweep(jobs, reference, manifest, register=flirt,
+              metrics=('mi', 'corr'), mask=None, bins=256, n_jobs=None,
+              verbose=True):
+    # Registers every job's input to `reference` with `register`, then
+    # scores the output against the reference. Each finished job is
+    # appended to the `manifest` (JSON lines), and jobs already recorded
+    # there with an existing output are skipped, so an interrupted sweep
+    # resumes where it stopped. Returns the records in the order of `jobs`.
+    done = load_manifest(manifest)
+    todo = [job for job in jobs if not (job['output'] in done and
+                                        os.path.exists(job['output']))]
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(min(n_jobs, len(todo)), 1)
+
+    args = [(job, register, metrics) for job in todo]
+    initargs = (reference, mask, bins)
+    with open(manifest, 'a') as f:
+        if n_jobs > 1:
+            with Pool(n_jobs, initializer=_init_worker,
+                      initargs=initargs) as pool:
+                for record in pool.imap_unordered(_sweep_worker, args):
+                    _record(f, done, record, verbose)
+        else:
+            _init_worker(*initargs)
+            for arg in args:
+                _record(f, done, _sweep_worker(arg), verbose)
+            _worker.clear()
+
+    return [done[job['output']] for job in jobs]
+
+
+def _record(f, done, record, verbose):
+    f.write(json.dumps(record) + '\n')
+    f.flush()
+    done[record['output']] = record
+    if verbose:
+        print('{}: {}'.format(record['output'], record['scores']))
+
+
+_worker = {}
+
+
+def _init_worker(reference, mask, bins):
+    _worker['reference'] = reference
+    _, ref = load_data(reference, cache=False)
+    _worker['metrics'] = RegistrationMetrics(ref, bins, mask)
+
+
+def _sweep_worker(args):
+    job, register, metrics = args
+    outdir = os.path.dirname(job['output'])
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+
+    register(job['input'], job['output'], _worker['reference'],
+             **job['config'])
+
+    _, vol = load_data(job['output'], cache=False)
+    scores = _worker['metrics'].score(vol, metrics)
+    record = dict(job)
+    record['scores'] = {m: float(s) for m, s in zip(metrics, scores)}
+    return record
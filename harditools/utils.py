@@ -1,14 +1,38 @@
 import numpy as np
 import nibabel as nib
+from numpy.lib.mixins import NDArrayOperatorsMixin
 from dipy.core.gradients import gradient_table
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import subprocess
 import pickle
 import pkg_resources
+from collections import OrderedDict
+from .instrument import instrumented
 data_path = pkg_resources.resource_filename('harditools', 'data/')
 
 
+# Bytes of in-memory data load_data keeps in its LRU cache (memory maps
+# count as nothing, since the page cache can drop them). 0, the default,
+# turns the cache off.
+LOAD_CACHE_BYTES = int(os.environ.get('HARDITOOLS_LOAD_CACHE_BYTES', 0))
+_load_cache = OrderedDict()
+
+# Directory for uncompressed copies of .nii.gz inputs, or None to read
+# them compressed
+NII_CACHE_DIR = os.environ.get('HARDITOOLS_NII_CACHE')
+_file_hashes = {}
+
+# Gradient tables by (path, mtime) of their files
+_gtab_cache = {}
+
+
 def load_mask(fn):
-    mask = nib.load(fn).get_data().astype(np.bool)
-    return mask
+    _, data = load_data(fn, dtype='bool')
+    return data
 
 
 def load_gtab(all_b0s=True, bvalfn=None, bvecfn=None):
@@ -20,19 +44,365 @@ def load_gtab(all_b0s=True, bvalfn=None, bvecfn=None):
             bvalfn = data_path + 'bvals'
             bvecfn = data_path + 'bvecs'
 
-    gtab = gradient_table(bvalfn, bvecfn, atol=1)
-    return gtab
+    # Parsed once per file version
+    key = tuple((os.path.abspath(fn), os.stat(fn).st_mtime_ns)
+                for fn in [bvalfn, bvecfn])
+    if key not in _gtab_cache:
+        _gtab_cache[key] = gradient_table(bvalfn, bvecfn, atol=1)
+    return _gtab_cache[key]
+
+
+def load_scheme(all_b0s=True, bvalfn=None, bvecfn=None):
+    return GradientScheme.from_gtab(load_gtab(all_b0s, bvalfn, bvecfn))
+
+
+class GradientScheme(object):
+    # b-values and b-vectors of a 4D dataset together with the order of
+    # its volumes: volume i of the (permuted) scheme is volume order[i] of
+    # the data it was built for. Permutations compose and are only applied
+    # to the data when it is used, so the gradient files and the data
+    # order can not diverge.
+    def __init__(self, bvals, bvecs, order=None, b0_thr=50):
+        self._bvals = np.asarray(bvals, dtype='float64')
+        self._bvecs = np.asarray(bvecs, dtype='float64').reshape(-1, 3)
+        if order is None:
+            order = np.arange(self._bvals.size)
+        self.order = np.asarray(order, dtype='intp')
+        self.b0_thr = b0_thr
+        self._gtab = None
+
+    @classmethod
+    def from_gtab(cls, gtab):
+        return cls(gtab.bvals, gtab.bvecs, b0_thr=gtab.b0_threshold)
+
+    @classmethod
+    def from_files(cls, bvalfn, bvecfn):
+        return cls.from_gtab(load_gtab(bvalfn=bvalfn, bvecfn=bvecfn))
+
+    def __len__(self):
+        return self.order.size
+
+    @property
+    def bvals(self):
+        return self._bvals[self.order]
+
+    @property
+    def bvecs(self):
+        return self._bvecs[self.order]
+
+    @property
+    def b0s_mask(self):
+        return self.bvals <= self.b0_thr
+
+    @property
+    def gtab(self):
+        if self._gtab is None:
+            self._gtab = gradient_table(self.bvals, self.bvecs, atol=1,
+                                        b0_threshold=self.b0_thr)
+        return self._gtab
+
+    def permute(self, order):
+        # Scheme with its volumes in `order` (indices into this scheme)
+        return GradientScheme(self._bvals, self._bvecs,
+                              self.order[np.asarray(order, dtype='intp')],
+                              self.b0_thr)
+
+    def __getitem__(self, index):
+        return self.permute(np.arange(len(self))[index])
+
+    def interleave_b0s(self, every=9):
+        return self.permute(interleave_b0s(self.bvals, every, self.b0_thr))
+
+    def apply(self, data):
+        # Volumes of the 4D `data` (in the original order) in the order of
+        # this scheme, as views, e.g. for merge_volumes
+        if data.shape[-1] != self._bvals.size:
+            raise ValueError('Data has {} volumes, scheme expects {}'.format(
+                data.shape[-1], self._bvals.size))
+        return split_volumes(data, self.order)
+
+    def save(self, bvalfn, bvecfn):
+        # FSL format: one row of b-values, three rows of b-vector components
+        with open(bvalfn, 'w') as f:
+            f.write(' '.join('{:g}'.format(b) for b in self.bvals) + '\n')
+        with open(bvecfn, 'w') as f:
+            for row in self.bvecs.T:
+                f.write(' '.join('{}'.format(v) for v in row) + '\n')
+
 
+def _loaded(args, result):
+    return {'fn': args['fn'], 'nbytes': result[1].nbytes}
 
-def load_data(fn):
-    img = nib.load(fn)
-    data = img.get_data()
+
+@instrumented(info=_loaded)
+def load_data(fn, dtype=None, slicer=None, cache=True, decompress=None):
+    # Reads the image data through the nibabel array proxy. Uncompressed
+    # files are memory mapped, so nothing is read until it is used, and
+    # `slicer` (e.g. np.s_[:, :, 10:20] or np.s_[..., 8]) only reads that
+    # part of the file. `dtype` casts the data (default: the dtype on disk,
+    # or float64 if the image is scaled). When LOAD_CACHE_BYTES is set,
+    # results are kept in an LRU cache keyed on the path, its mtime and the
+    # arguments, and repeated calls return the same arrays, so callers that
+    # modify the data in place should pass cache=False. With `decompress`
+    # (default: on when NII_CACHE_DIR is set) .nii.gz files are read from
+    # an uncompressed copy made by `decompressed`.
+    if decompress is None:
+        decompress = NII_CACHE_DIR is not None
+
+    cache = cache and LOAD_CACHE_BYTES > 0
+    key = None
+    if cache:
+        stat = os.stat(fn)
+        key = (os.path.abspath(fn), stat.st_mtime_ns, stat.st_size,
+               None if dtype is None else np.dtype(dtype).str, repr(slicer))
+        if key in _load_cache:
+            _load_cache.move_to_end(key)
+            return _load_cache[key]
+
+    if decompress and fn.endswith('.gz'):
+        img = nib.load(decompressed(fn))
+    else:
+        img = nib.load(fn)
+    if slicer is None:
+        data = np.asanyarray(img.dataobj)
+    else:
+        data = img.dataobj[slicer]
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+
+    if cache and _cached_bytes(data) <= LOAD_CACHE_BYTES:
+        _load_cache[key] = (img, data)
+        while sum(_cached_bytes(d) for _, d in _load_cache.values()) > \
+                LOAD_CACHE_BYTES:
+            _load_cache.popitem(last=False)
 
     return img, data
 
 
-def save_data(fn, data, img):
-    nib.save(nib.Nifti1Image(data, img.affine), fn)
+def clear_load_cache():
+    _load_cache.clear()
+
+
+def _cached_bytes(data):
+    return 0 if isinstance(data, np.memmap) else data.nbytes
+
+
+def _saved(args, result):
+    return {'fn': args['fn'], 'nbytes': args['data'].nbytes}
+
+
+@instrumented(info=_saved)
+def save_data(fn, data, img, compresslevel=None):
+    # `compresslevel` (0-9) sets the gzip level of .nii.gz outputs, e.g. 1
+    # for intermediate files. Use a .nii name for uncompressed output.
+    new_img = nib.Nifti1Image(data, img.affine)
+    if compresslevel is None or not fn.endswith('.gz'):
+        nib.save(new_img, fn)
+        return
+
+    fd, niifn = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(fn) or '.')
+    os.close(fd)
+    try:
+        nib.save(new_img, niifn)
+        gzip_file(niifn, fn, compresslevel=compresslevel)
+    finally:
+        if os.path.exists(niifn):
+            os.remove(niifn)
+
+
+def create_data(fn, shape, dtype, img):
+    # Writes the header of an uncompressed NIfTI file of `shape` with the
+    # affine of `img` and returns a writable memmap of its (zero) data, so
+    # that large outputs can be filled in piece by piece
+    if fn.endswith('.gz'):
+        raise ValueError('create_data can only write uncompressed files')
+
+    hdr = _nifti_header(shape, dtype, img)
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(fn, 'wb') as f:
+        _write_header(f, hdr)
+        f.truncate(352 + nbytes)
+
+    return np.memmap(fn, dtype=hdr.get_data_dtype(), mode='r+', offset=352,
+                     shape=shape, order='F')
+
+
+def _nifti_header(shape, dtype, img):
+    hdr = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype),
+                          img.affine).header
+    hdr.set_data_shape(shape)
+    hdr.set_data_offset(352)
+    return hdr
+
+
+def _write_header(f, hdr):
+    hdr.write_to(f)
+    f.write(b'\0' * (352 - f.tell()))
+
+
+def split_volumes(data, order=None):
+    # Volumes of a 4D array as views (data[..., i]), nothing is copied or
+    # read until used. `order` picks and reorders the volumes.
+    if order is None:
+        order = range(data.shape[-1])
+    return [data[..., i] for i in order]
+
+
+def interleave_b0s(bvals, every=9, b0_thr=50):
+    # Volume order that puts one b0 before each run of `every` DWIs, keeping
+    # the b0s and DWIs in their original order, e.g. for data acquired with
+    # all the b0s first. Leftover b0s or DWIs go at the end.
+    bvals = np.asarray(bvals)
+    b0s = np.flatnonzero(bvals <= b0_thr)
+    dwis = np.flatnonzero(bvals > b0_thr)
+
+    order = []
+    ngroups = min(b0s.size, -(-dwis.size // every))
+    for g in range(ngroups):
+        order.append(b0s[g])
+        order.extend(dwis[g * every:(g + 1) * every])
+    order.extend(b0s[ngroups:])
+    order.extend(dwis[ngroups * every:])
+    return np.array(order, dtype='intp')
+
+
+@instrumented(info=lambda args, result: {'fn': args['fn']})
+def merge_volumes(fn, volumes, img=None, dtype=None, compresslevel=9):
+    # Writes a 4D NIfTI file from a sequence of 3D volumes (arrays, e.g.
+    # from split_volumes, or filenames) in one streaming pass: a NIfTI
+    # volume is a contiguous block of the file, so each one is written as
+    # soon as it is read. .nii.gz outputs are compressed on the fly (through
+    # pigz when it is installed). The file is written under a temporary
+    # name first, so `fn` may be one of the inputs.
+    volumes = list(volumes)
+    if img is None:
+        if not isinstance(volumes[0], str):
+            raise ValueError('merge_volumes needs a reference img (for the '
+                             'affine) when the volumes are arrays')
+        img = nib.load(volumes[0])
+    first = _volume(volumes[0])
+    if dtype is None:
+        dtype = first.dtype
+    hdr = _nifti_header(first.shape + (len(volumes),), dtype, img)
+
+    tmpfn = fn + '.part'
+    try:
+        with open(tmpfn, 'wb') as f:
+            if fn.endswith('.gz'):
+                _write_volumes_gz(f, hdr, volumes, dtype, compresslevel)
+            else:
+                _write_volumes(f, hdr, volumes, dtype)
+        os.replace(tmpfn, fn)
+    finally:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+    return fn
+
+
+def _write_volumes_gz(f, hdr, volumes, dtype, compresslevel):
+    pigz = shutil.which('pigz')
+    if pigz is None:
+        with gzip.GzipFile(fileobj=f, mode='wb',
+                           compresslevel=compresslevel) as gz:
+            _write_volumes(gz, hdr, volumes, dtype)
+        return
+
+    proc = subprocess.Popen([pigz, '-{}'.format(compresslevel), '-c'],
+                            stdin=subprocess.PIPE, stdout=f)
+    try:
+        _write_volumes(proc.stdin, hdr, volumes, dtype)
+    finally:
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, pigz)
+
+
+def _write_volumes(f, hdr, volumes, dtype):
+    _write_header(f, hdr)
+    shape = hdr.get_data_shape()[:-1]
+    for vol in volumes:
+        vol = _volume(vol)
+        if vol.shape != shape:
+            raise ValueError('Volume shape {} does not match {}'.format(
+                vol.shape, shape))
+        f.write(np.asarray(vol, dtype=dtype).tobytes(order='F'))
+
+
+def _volume(vol):
+    if isinstance(vol, str):
+        _, vol = load_data(vol, cache=False)
+    return vol
+
+
+def gzip_file(fn, gzfn=None, remove=True, compresslevel=9):
+    # Streams `fn` into a gzip file without reading it all into memory,
+    # using all cores through pigz when it is installed
+    if gzfn is None:
+        gzfn = fn + '.gz'
+
+    pigz = shutil.which('pigz')
+    if pigz is not None:
+        with open(gzfn, 'wb') as dst:
+            subprocess.run([pigz, '-{}'.format(compresslevel), '-c', fn],
+                           stdout=dst, check=True)
+    else:
+        with open(fn, 'rb') as src, \
+                gzip.open(gzfn, 'wb', compresslevel=compresslevel) as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+
+    if remove:
+        os.remove(fn)
+    return gzfn
+
+
+def gunzip_file(gzfn, fn):
+    # Inflates `gzfn` into `fn`. pigz can not inflate in parallel, but it
+    # reads, writes and checksums in separate threads.
+    pigz = shutil.which('pigz')
+    with open(fn, 'wb') as dst:
+        if pigz is not None:
+            subprocess.run([pigz, '-dc', gzfn], stdout=dst, check=True)
+        else:
+            with gzip.open(gzfn, 'rb') as src:
+                shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+    return fn
+
+
+def file_hash(fn):
+    # sha1 of the contents of `fn`, remembered for as long as its mtime
+    # and size do not change
+    stat = os.stat(fn)
+    key = (os.path.abspath(fn), stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(16 * 1024 * 1024), b''):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def decompressed(fn, cache_dir=None):
+    # Returns the path of an uncompressed, memory-mappable copy of the
+    # .nii.gz file `fn` in `cache_dir` (default NII_CACHE_DIR). The copy is
+    # named after the hash of the compressed file, and is only inflated the
+    # first time it is asked for.
+    if cache_dir is None:
+        cache_dir = NII_CACHE_DIR
+    if cache_dir is None:
+        raise ValueError('No cache_dir given and NII_CACHE_DIR is not set')
+
+    niifn = os.path.join(cache_dir, file_hash(fn) + '.nii')
+    if not os.path.exists(niifn):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpfn = '{}.{}.tmp'.format(niifn, os.getpid())
+        try:
+            gunzip_file(fn, tmpfn)
+            os.replace(tmpfn, niifn)
+        finally:
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+    return niifn
 
 
 def save_obj(obj, fn):
@@ -66,6 +436,63 @@ def unmask(data, mask, dtype=np.float):
     return unmasked
 
 
+class MaskedVolume(NDArrayOperatorsMixin):
+    # Read-only volume view of `data`, which holds the values of the voxels
+    # in `mask` (i.e. data = volume[mask]). The full volume is only built
+    # when the view is used as an array. Indexing with a boolean array of
+    # the mask shape, and elementwise operations with scalars that leave
+    # the background at zero, are computed on `data` alone.
+    __slots__ = ('data', 'mask')
+
+    def __init__(self, data, mask):
+        self.data = data
+        self.mask = mask
+
+    @property
+    def shape(self):
+        return self.mask.shape + self.data.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return unmask(self.data, self.mask,
+                      dtype=self.data.dtype if dtype is None else dtype)
+
+    def __getitem__(self, idx):
+        if (isinstance(idx, np.ndarray) and idx.dtype == bool and
+                idx.shape == self.mask.shape):
+            out = np.zeros((idx.sum(),) + self.data.shape[1:],
+                           dtype=self.data.dtype)
+            out[self.mask[idx]] = self.data[idx[self.mask]]
+            return out
+        return np.asarray(self)[idx]
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        lazy = (method == '__call__' and 'out' not in kwargs and
+                all(np.isscalar(x) or (isinstance(x, MaskedVolume) and
+                                       x.mask is self.mask) for x in inputs))
+        if lazy:
+            inside = ufunc(*[x.data if isinstance(x, MaskedVolume) else x
+                             for x in inputs], **kwargs)
+            outside = ufunc(*[0 if isinstance(x, MaskedVolume) else x
+                              for x in inputs], **kwargs)
+            if not isinstance(inside, tuple) and outside == 0:
+                return MaskedVolume(inside, self.mask)
+
+        inputs = [np.asarray(x) if isinstance(x, MaskedVolume) else x
+                  for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+
 def ang_distance(dir1, dir2):
     costheta = (dir1 * dir2).sum(axis=1) / \
         (np.linalg.norm(dir1, axis=1) * np.linalg.norm(dir2, axis=1))
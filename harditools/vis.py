@@ -1,13 +1,13 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from dipy.viz import window, actor
-from dipy.data import get_sphere
-from .reconst import Peaks
+from .reconst import Peaks, load_sphere
+from .stats import Histogram, bin_edges
 
 
 def quick_vis(obj, _slice=None, sphere=None):
     if sphere == None:
-        sphere = get_sphere('symmetric724')
+        sphere = load_sphere()
 
     ren = window.Renderer()
 
@@ -36,21 +36,63 @@ def plot_diff_hists(raw_data, denoised_data_list, metricfunc,
                     fn='diff_hists.pdf',
                     nbins=512, figsize=(12, 12),
                     xticks=None, plotmax=True,
-                    sharex=True):
+                    sharex=True, chunk_size=1000000):
+    # Entries of `denoised_data_list` that are already Histograms are drawn
+    # as they are; arrays are reduced to a Histogram of
+    # metricfunc(d, raw_data) chunk by chunk
+    hists = [d if isinstance(d, Histogram) else
+             diff_hist(raw_data, d, metricfunc, nbins, chunk_size)
+             for d in denoised_data_list]
+    plot_hists(hists, title, xlabel, ylabel=ylabel, show=show, save=save,
+               fn=fn, figsize=figsize, xticks=xticks, plotmax=plotmax,
+               sharex=sharex)
 
-    fig, axes = plt.subplots(3, 1, sharex=sharex, figsize=figsize)
-    names = ['{0} x {0} x {0}'.format(i) for i in [5, 7, 9]]
-    colors = ['C{}'.format(i) for i in range(3)]
 
-    for i, (ax, d) in enumerate(zip(axes.flatten(), denoised_data_list)):
-        diff = metricfunc(d, raw_data)
-        counts, bins, _ = ax.hist(diff, bins=nbins, color=colors[i])
+def diff_hist(raw_data, data, metricfunc, nbins=512, chunk_size=1000000):
+    # Histogram of metricfunc(data, raw_data), computed a chunk at a time.
+    # With a number of bins, a first pass finds the range of the finite
+    # differences, so the bins cover all of them as with ax.hist.
+    def diffs():
+        for start in range(0, len(raw_data), chunk_size):
+            yield metricfunc(data[start:start + chunk_size],
+                             raw_data[start:start + chunk_size])
+
+    bins = nbins
+    if np.ndim(nbins) == 0:
+        lo, hi = np.inf, -np.inf
+        for diff in diffs():
+            finite = diff[np.isfinite(diff)]
+            if finite.size:
+                lo, hi = min(lo, finite.min()), max(hi, finite.max())
+        bins = bin_edges(lo, hi, nbins)
+
+    hist = Histogram(bins)
+    for diff in diffs():
+        hist.add(diff)
+    return hist
+
+
+def plot_hists(hists, title, xlabel, ylabel='Counts', names=None,
+               show=True, save=False,
+               fn='diff_hists.pdf',
+               figsize=(12, 12),
+               xticks=None, plotmax=True,
+               sharex=True):
+    # Same layout as plot_diff_hists, drawn from precomputed Histograms
+    # (e.g. the entries of a compare.Comparison)
+    fig, axes = plt.subplots(len(hists), 1, sharex=sharex, figsize=figsize,
+                             squeeze=False)
+    if names is None:
+        names = ['{0} x {0} x {0}'.format(i) for i in [5, 7, 9]]
+    colors = ['C{}'.format(i) for i in range(len(hists))]
+
+    for i, (ax, hist) in enumerate(zip(axes.flatten(), hists)):
+        ax.hist(hist.centers, bins=hist.bins, weights=hist.counts,
+                color=colors[i])
         ylow, yhigh = ax.get_ylim()
         if plotmax:
-            maxbin = (bins[np.argmax(counts)] +
-                      bins[np.argmax(counts) + 1]) / 2
-            ax.plot([maxbin, maxbin], [ylow, yhigh],
-                    'k-', label='Max: {:.2f}\nStd: {:.1f}'.format(maxbin, diff.std()))
+            ax.plot([hist.mode, hist.mode], [ylow, yhigh],
+                    'k-', label='Max: {:.2f}\nStd: {:.1f}'.format(hist.mode, hist.std))
             ax.legend()
         ax.set_title(names[i])
         ax.set_xlabel(xlabel)
@@ -70,5 +112,56 @@ def plot_diff_hists(raw_data, denoised_data_list, metricfunc,
     plt.close('all')
 
 
+def plot_boxes(hists, title, xlabel, ylabel='L$_{max}$', names=None,
+               show=True, save=False,
+               fn='boxes.pdf',
+               figsize=(12, 12),
+               xticks=None,
+               sharex=True):
+    # Horizontal box plots (no fliers) of per-band Histograms, e.g.
+    # compare.Comparison['power'], with quartiles from their sketches
+    fig, axes = plt.subplots(len(hists), 1, sharex=sharex, figsize=figsize,
+                             squeeze=False)
+    if names is None:
+        names = ['{0} x {0} x {0}'.format(i) for i in [5, 7, 9]]
+
+    for i, (ax, bands) in enumerate(zip(axes.flatten(), hists)):
+        ax.bxp([boxstats(hist) for hist in bands], vert=False,
+               showfliers=False)
+        ax.plot([0, 0], [0.5, len(bands) + 0.5], 'k:')
+        ax.set_title(names[i])
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_yticklabels(np.arange(0, 2 * len(bands), 2))
+        if xticks is not None:
+            ax.set_xticks(xticks)
+
+    plt.tight_layout()
+    fig.subplots_adjust(top=0.92)
+    fig.suptitle(title, fontweight='bold')
+
+    if show:
+        plt.show()
+    if save:
+        plt.savefig(fn)
+    plt.close('all')
+
+
+def boxstats(hist, whis=1.5):
+    # Box plot statistics for ax.bxp. As in ax.boxplot, the whiskers end at
+    # the furthest values within `whis` IQRs of the box, taken exactly from
+    # the data range when it lies inside and from the sketch otherwise.
+    q1, med, q3 = hist.quantile([0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    lo, hi = q1 - whis * iqr, q3 + whis * iqr
+    whislo, whishi = hist.moments.min, hist.moments.max
+    if whislo < lo:
+        whislo = min(hist.sketch.extent(lo, q1)[0], q1)
+    if whishi > hi:
+        whishi = max(hist.sketch.extent(q3, hi)[1], q3)
+    return {'med': med, 'q1': q1, 'q3': q3,
+            'whislo': whislo, 'whishi': whishi, 'fliers': []}
+
+
 def boxprep(obj, mask):
     return obj.power[mask].reshape(-1, obj.power.shape[-1])
@@ -0,0 +1,18 @@
+# Denoises the DWI data with MP-PCA [Veraart2016] for the 5, 7 and 9 voxel
+# kernels in one pass, writing the denoised data, the sigma map and the
+# residual (raw - denoised, previously get_noise_image.sh) of each
+import harditools as hd
+
+data = '../../x_raw_data/raw_data.nii.gz'
+extents = [5, 7, 9]
+
+img, raw = hd.load_data(data, dtype='float32', cache=False)
+results = hd.denoise.mppca_sweep(raw, extents, n_jobs=None)
+
+for k in extents:
+    print(k)
+    denoised, sigma = results[k]
+    base = 'denoised_k{0}/'.format(k)
+    hd.save_data(base + 'denoised_k{}.nii.gz'.format(k), denoised, img)
+    hd.save_data(base + 'sigma_k{}.nii.gz'.format(k), sigma, img)
+    hd.save_data(base + 'noise_k{}.nii.gz'.format(k), raw - denoised, img)
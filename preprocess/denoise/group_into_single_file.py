@@ -0,0 +1,17 @@
+# Reorders the denoised data (16 b0s followed by 144 DWIs) into a single
+# file with 1 b0 every 9 DWIs, in one pass and without splitting it into
+# per-volume files first. The input is left as it is, so the script can be
+# rerun safely; the output is what csd/compare_denoise_widths/swap_data.sh
+# reads.
+import numpy as np
+import harditools as hd
+
+bvals = np.r_[np.zeros(16), 3000 * np.ones(144)]
+order = hd.interleave_b0s(bvals, every=9)
+
+for k in [5, 7, 9]:
+    print(k)
+    base = 'denoised_k{0}/denoised_k{0}'.format(k)
+    img, data = hd.load_data(base + '.nii.gz', cache=False)
+    hd.merge_volumes(base + '_true_order.nii.gz',
+                     hd.split_volumes(data, order), img)
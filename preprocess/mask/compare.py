@@ -1,10 +1,10 @@
 import numpy as np
-import nibabel as nib
+import harditools as hd
 
-raw = nib.load('./raw_mask.nii.gz').get_data()
-d5 = nib.load('./denoised_k5_mask.nii.gz').get_data()
-d7 = nib.load('./denoised_k7_mask.nii.gz').get_data()
-d9 = nib.load('./denoised_k9_mask.nii.gz').get_data()
+_, raw = hd.load_data('./raw_mask.nii.gz')
+_, d5 = hd.load_data('./denoised_k5_mask.nii.gz')
+_, d7 = hd.load_data('./denoised_k7_mask.nii.gz')
+_, d9 = hd.load_data('./denoised_k9_mask.nii.gz')
 
 names = ['raw', 'd5', 'd7', 'd9']
 
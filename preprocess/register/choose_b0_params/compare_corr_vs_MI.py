@@ -1,26 +1,7 @@
 import numpy as np
-import nibabel as nib
+import harditools as hd
 import matplotlib.pyplot as plt
-
-
-def MI(im1, im2, bins=256):
-    # Mutual information for joint histogram
-
-    hgram, _, _ = np.histogram2d(im1.ravel(), im2.ravel(), bins=bins)
-
-    # Convert bins counts to probability values
-    pxy = hgram / hgram.sum()
-
-    px = pxy.sum(axis=1)  # marginal for x over y
-    py = pxy.sum(axis=0)  # marginal for y over x
-    px_py = px[:, None] * py[None, :]  # Broadcast to multiply marginals
-    # Now we can do the calculation using the pxy, px_py 2D arrays
-    nzs = pxy > 0  # Only non-zero pxy values contribute to the sum
-    return np.sum(pxy[nzs] * np.log(pxy[nzs] / px_py[nzs]))
-
-
-def corr(vol1, vol2):
-    return np.corrcoef(vol1.flatten(), vol2.flatten())[0, 1]
+from harditools.registration_metrics import score_volumes
 
 
 calc = True
@@ -33,11 +14,9 @@ if calc:
     for i, dof in enumerate(dofs):
         print('Cost: corratio, dof: {}'.format(dof))
         basefn = './corratio_{dof}/corratio_{dof}_n'.format(dof=dof)
-        ref = nib.load(basefn + '0008.nii.gz').get_data()
-
-        for j, n in enumerate(volnums):
-            vol = nib.load(basefn + '{:04d}.nii.gz'.format(n)).get_data()
-            corr_rs[i, j] = corr(ref, vol)
+        _, ref = hd.load_data(basefn + '0008.nii.gz')
+        fns = [basefn + '{:04d}.nii.gz'.format(n) for n in volnums]
+        corr_rs[i] = score_volumes(ref, fns, ['corr'], n_jobs=None)['corr']
 
     # ANALYZING mutualinfo COST FUNCTION
     mutualinfo_MIs = np.zeros((4, 15))
@@ -45,11 +24,10 @@ if calc:
     for i, dof in enumerate(dofs):
         print('Cost: mutualinfo, dof: {}'.format(dof))
         basefn = './mutualinfo_{dof}/mutualinfo_{dof}_n'.format(dof=dof)
-        ref = nib.load(basefn + '0008.nii.gz').get_data()
-
-        for j, n in enumerate(volnums):
-            vol = nib.load(basefn + '{:04d}.nii.gz'.format(n)).get_data()
-            mutualinfo_MIs[i, j] = MI(ref, vol, 256)
+        _, ref = hd.load_data(basefn + '0008.nii.gz')
+        fns = [basefn + '{:04d}.nii.gz'.format(n) for n in volnums]
+        mutualinfo_MIs[i] = score_volumes(ref, fns, ['mi'], bins=256,
+                                          n_jobs=None)['mi']
 
 # Getting optimal choice
 choices = [np.argmax(f.mean(axis=1))
@@ -1,5 +1,5 @@
 import numpy as np
-import nibabel as nib
+import harditools as hd
 import matplotlib.pyplot as plt
 
 
@@ -17,16 +17,16 @@ w_basefn = './corratio_12_weighted_n8/corratio_12_n'
 w0_basefn = './corratio_12_weighted_n0/corratio_12_n'
 nw_basefn = './corratio_12/corratio_12_n'
 
-ref = nib.load(w_basefn + '0008.nii.gz').get_data()
+_, ref = hd.load_data(w_basefn + '0008.nii.gz')
 
 for j, n in enumerate(volnums):
-    w_vol = nib.load(w_basefn + '{:04d}.nii.gz'.format(n)).get_data()
+    _, w_vol = hd.load_data(w_basefn + '{:04d}.nii.gz'.format(n), cache=False)
     corr_w_rs[j] = corr(ref, w_vol)
 
-    w0_vol = nib.load(w0_basefn + '{:04d}.nii.gz'.format(n)).get_data()
+    _, w0_vol = hd.load_data(w0_basefn + '{:04d}.nii.gz'.format(n), cache=False)
     corr_w0_rs[j] = corr(ref, w0_vol)
 
-    nw_vol = nib.load(nw_basefn + '{:04d}.nii.gz'.format(n)).get_data()
+    _, nw_vol = hd.load_data(nw_basefn + '{:04d}.nii.gz'.format(n), cache=False)
     corr_nw_rs[j] = corr(ref, nw_vol)
 
 fig, ax = plt.subplots()
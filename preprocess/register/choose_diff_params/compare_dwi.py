@@ -1,22 +1,8 @@
 import numpy as np
-import nibabel as nib
+import harditools as hd
 import matplotlib.pyplot as plt
-
-
-def MI(im1, im2, bins=256):
-    # Mutual information for joint histogram
-
-    hgram, _, _ = np.histogram2d(im1.ravel(), im2.ravel(), bins=bins)
-
-    # Convert bins counts to probability values
-    pxy = hgram / hgram.sum()
-
-    px = pxy.sum(axis=1)  # marginal for x over y
-    py = pxy.sum(axis=0)  # marginal for y over x
-    px_py = px[:, None] * py[None, :]  # Broadcast to multiply marginals
-    # Now we can do the calculation using the pxy, px_py 2D arrays
-    nzs = pxy > 0  # Only non-zero pxy values contribute to the sum
-    return np.sum(pxy[nzs] * np.log(pxy[nzs] / px_py[nzs]))
+from harditools.registration_metrics import (RegistrationMetrics,
+                                              score_volumes)
 
 
 calc = False
@@ -24,7 +10,9 @@ if calc:
     dofs = np.array([3, 6, 9, 12])
     volnums = np.arange(16, 160)
     weightstrs = ['w', 'nw']
-    ref = nib.load('../registered_b0/mean_registered_b0.nii.gz').get_data()
+    _, ref = hd.load_data('../registered_b0/mean_registered_b0.nii.gz')
+    # Reference binning is shared by every weighting, dof and volume
+    ref = RegistrationMetrics(ref)
 
     # shape = (weighting, dof, volume)
     MIs = np.zeros((2, dofs.size, volnums.size))
@@ -33,11 +21,9 @@ if calc:
         for j, dof in enumerate(dofs):
             basefn = 'dof{}_{}'.format(dof, weighting)
             print(basefn)
-            for k, n in enumerate(volnums):
-                print(n)
-                vol = nib.load(
-                    basefn + '/{}_n{:04d}.nii.gz'.format(basefn, n)).get_data()
-                MIs[i, j, k] = MI(ref, vol)
+            fns = [basefn + '/{}_n{:04d}.nii.gz'.format(basefn, n)
+                   for n in volnums]
+            MIs[i, j] = score_volumes(ref, fns, ['mi'], n_jobs=None)['mi']
 
 # Getting optimal choice
 choices = MIs.mean(axis=2).argmax(axis=1)  # DOF index for w and nw
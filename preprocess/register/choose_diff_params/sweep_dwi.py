@@ -0,0 +1,30 @@
+# Python version of make_siraf_scripts.sh + choose_diff_params.sh: registers
+# every DWI for each weighting and dof in parallel, scoring each output as it
+# finishes. Rerunning skips the registrations already in the manifest.
+import numpy as np
+import harditools as hd
+
+fnbase = '../../denoise/denoised_k7/denoised_k7'
+reference = '../registered_b0/mean_registered_b0.nii.gz'
+
+weightings = ['w', 'nw']
+dofs = [3, 6, 9, 12]
+volnums = np.arange(16, 160)
+
+configs = hd.sweep.grid(weighting=weightings, dof=dofs,
+                        cost=['mutualinfo'], interp=['sinc'])
+inputs = ['{}_n{:04d}.nii.gz'.format(fnbase, n) for n in volnums]
+# Outputs are named dof{dof}_{weighting}/dof{dof}_{weighting}_n{:04d}, as
+# the shell sweep named them and compare_dwi.py reads them
+jobs = hd.sweep.make_jobs(
+    inputs, configs,
+    'dof{dof}_{weighting}/dof{dof}_{weighting}_{name}.nii.gz',
+    names=['n{:04d}'.format(n) for n in volnums])
+
+records = hd.sweep.run_sweep(jobs, reference, 'sweep_manifest.jsonl',
+                             register=hd.sweep.flirt, metrics=['mi'])
+
+# shape = (weighting, dof, volume), as in compare_dwi.py
+MIs = np.array([r['scores']['mi'] for r in records]).reshape(
+    len(weightings), len(dofs), volnums.size)
+np.save('dwi_MIs.npy', MIs)
@@ -0,0 +1,17 @@
+import numpy as np
+from harditools.registration_metrics import bin_indices, RegistrationMetrics
+
+
+def test_joint_histogram_matches_histogram2d_on_integers():
+    rng = np.random.RandomState(0)
+    for _ in range(250):
+        ref = rng.randint(0, rng.randint(2, 5000), size=(10, 12, 9))
+        vol = rng.randint(0, rng.randint(2, 5000), size=(10, 12, 9))
+        expected, _, _ = np.histogram2d(ref.ravel(), vol.ravel(), bins=64)
+        hgram = RegistrationMetrics(ref, bins=64).joint_histogram(vol)
+        np.testing.assert_array_equal(hgram, expected)
+
+
+def test_bin_indices_of_constant_data():
+    counts = np.bincount(bin_indices(np.full(10, 3.), 8), minlength=8)
+    np.testing.assert_array_equal(counts, np.histogram(np.full(10, 3.), 8)[0])
@@ -0,0 +1,24 @@
+import numpy as np
+from harditools.stats import Moments, Histogram
+
+
+def test_moments_match_numpy():
+    rng = np.random.RandomState(0)
+    values = rng.randn(1000)
+    moments = Moments()
+    for chunk in np.array_split(values, 7):
+        moments.add(chunk)
+    assert moments.n == values.size
+    np.testing.assert_allclose(moments.mean, values.mean())
+    np.testing.assert_allclose(moments.std, values.std())
+
+
+def test_empty_accumulators_are_nan():
+    assert np.isnan(Moments().var)
+    assert np.isnan(Moments().std)
+
+    hist = Histogram(np.linspace(-1, 1, 9))
+    hist.add(np.array([np.nan, np.inf]))
+    assert hist.n == 0
+    assert np.isnan(hist.std)
+    assert np.isnan(hist.mean)